@@ -0,0 +1,114 @@
+#-*- coding: utf-8 -*-
+
+'''
+
+This module keeps the journal of an extraction run, so that a crashed or
+killed run can be resumed without extracting finished slices again nor
+duplicating the rows they appended to the outputs.
+
+'''
+
+from typing import Dict, List, Tuple
+import fcntl
+import errno
+import json
+import logging
+import os
+
+
+def output_sizes(outputs: List[str]) -> Dict[str, int]:
+    return {output: os.path.getsize(output) for output in outputs if os.path.exists(output)}
+
+
+class Journal:
+    '''
+    Append-only journal of the slices finished by an extraction run, one JSON
+    line each, holding the class, index and paths of the slice along with the
+    sizes of the shared outputs once its rows were flushed.
+
+    Slices are recorded once their rows are flushed to the outputs by the 
+    output sink, so sizes always match the rows of the journaled slices. 
+    Methods without outputs journal their slices once saved.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def start(self, outputs: List[str]) -> None:
+        ''' Begin the journal of a new run, outputs holding their headers only '''
+
+        self._rewrite([{'outputs': output_sizes(outputs)}])
+
+    def resume(self, outputs: List[str]) -> Dict[Tuple[str, int], List[str]]:
+        '''
+        Truncate outputs to the rows of the journaled slices, returning the
+        paths of those slices by (class, index).
+        '''
+
+        entries = self._load()
+        if not entries:
+            raise FileNotFoundError(errno.ENOENT, 'Missing journal to resume from', self.path)
+
+        finished, sizes = {}, entries[-1]['outputs']
+        for entry in entries:
+            if 'dataset' in entry:
+                finished[(entry['dataset'], entry['index'])] = entry['paths']
+
+        for output in outputs:
+            if output in sizes and os.path.getsize(output) > sizes[output]:
+                logging.info('dropping rows of unfinished slices from %s', output)
+                os.truncate(output, sizes[output])
+
+        # a line cut by the crash would garble the next records
+        self._rewrite(entries)
+        return finished
+
+    def add(self, dataset_class: str, index: int, paths: List[str], outputs: List[str]) -> None:
+        ''' Journal a slice whose rows are already flushed to the outputs '''
+
+        with open(self.path, 'a') as writer:
+            fcntl.flock(writer, fcntl.LOCK_EX)
+            try:
+                self._append(writer, dataset_class, index, paths, outputs)
+            finally:
+                fcntl.flock(writer, fcntl.LOCK_UN)
+
+    def finish(self) -> None:
+        ''' The run is complete, there is nothing left to resume '''
+
+        os.unlink(self.path)
+
+    def _append(self, 
+                writer: object, 
+                dataset_class: str, 
+                index: int, 
+                paths: List[str], 
+                outputs: List[str]) -> None:
+        entry = {
+            'dataset': dataset_class,
+            'index': index,
+            'paths': paths,
+            'outputs': output_sizes(outputs),
+        }
+        writer.write(f'{json.dumps(entry)}\n')
+        writer.flush()
+        os.fsync(writer.fileno())
+
+    def _load(self) -> List[dict]:
+        if not os.path.exists(self.path):
+            return []
+
+        entries = []
+        with open(self.path, 'r') as reader:
+            for line in reader:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logging.warning('ignoring journal records after a cut line: %s', line)
+                    break
+        return entries
+
+    def _rewrite(self, entries: List[dict]) -> None:
+        with open(self.path, 'w') as writer:
+            for entry in entries:
+                writer.write(f'{json.dumps(entry)}\n')
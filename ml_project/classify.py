@@ -15,12 +15,15 @@ from sklearn.naive_bayes import GaussianNB
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.neural_network import MLPClassifier
 from sklearn.metrics import confusion_matrix
-import cv2
+from numpy.lib import recfunctions
 import pandas
+import numpy
 
+from typing import List, Tuple
 from datetime import datetime
 import argparse
 import logging
+import json
 
 
 def parse_args():
@@ -46,6 +49,14 @@ def parse_args():
                         '--confusion-matrix', 
                         action='store_true',
                         help='Show the confusion matrix')
+    parser.add_argument('--columns', 
+                        help='Train on these comma separated features only',
+                        type=lambda value: value.split(','))
+    parser.add_argument('--rows', 
+                        help='Train on the rows from START to STOP only',
+                        metavar='START:STOP',
+                        type=lambda value: slice(*(int(bound) if bound else None 
+                                                   for bound in value.split(':'))))
     parser.add_argument('target_dataset', 
                         help='Specify the file containing traning data.',
                         type=argparse.FileType('r'))
@@ -67,8 +78,10 @@ def get_classifier(config: dict) -> object:
 def train(classifier: object, 
           train_dataset: str, 
           print_confusion_matrix: bool = False,
+          columns: List[str] = None,
+          rows: slice = None,
           **kwargs) -> GaussianNB:
-    X, y = load_simpsons_dataset(train_dataset)
+    X, y = load_simpsons_dataset(train_dataset, columns=columns, rows=rows)
 
     logging.info('starting training...')
     gnb = classifier(**kwargs).fit(X, y)
@@ -89,17 +102,68 @@ def train(classifier: object,
     return gnb
 
 
-def load_simpsons_dataset(target_file: str) -> None:
+def load_simpsons_dataset(target_file: str, 
+                          columns: List[str] = None, 
+                          rows: slice = None) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    '''
+    Features and classes of an extraction output, the class being its first
+    column. Only the given feature columns and slice of rows are loaded.
+    '''
+
+    if target_file.endswith('.npy'):
+        return load_npy_dataset(target_file, columns=columns, rows=rows)
+
     logging.debug('loading simpson\'s dataset from file...')
-    csv_data = pandas.read_csv(target_file)
-    X = csv_data.iloc[:, 1:].values
-    y = csv_data.iloc[:, 0].values
+    rows = rows or slice(None)
+    if rows.step is not None or (rows.start or 0) < 0 or (rows.stop or 0) < 0:
+        raise ValueError('Only forward row ranges can be read from a CSV file.')
+
+    usecols = None
+    if columns is not None:
+        class_column = pandas.read_csv(target_file, nrows=0).columns[0]
+        usecols = [class_column, *columns]
+
+    start = rows.start or 0
+    csv_data = pandas.read_csv(target_file, 
+                               usecols=usecols,
+                               skiprows=range(1, start + 1),
+                               nrows=None if rows.stop is None else max(rows.stop - start, 0))
+    if usecols is not None:
+        csv_data = csv_data[usecols]
+
+    X = csv_data.iloc[:, 1:].to_numpy(copy=False)
+    y = csv_data.iloc[:, 0].to_numpy(copy=False)
+    return X, y
+
+
+def load_npy_dataset(target_file: str, 
+                     columns: List[str] = None, 
+                     rows: slice = None) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    '''
+    Map an output of the npy format into memory: features are a view of the
+    file, read by pages as they are used, so loading takes the same time 
+    whatever its size. Classes are decoded from their codes.
+    '''
+
+    logging.debug('mapping simpson\'s dataset from file...')
+    records = numpy.load(target_file, mmap_mode='r')
+    if rows is not None:
+        records = records[rows]
+
+    class_column, *features = records.dtype.names
+    X = recfunctions.structured_to_unstructured(records[columns or features], copy=False)
+
+    classes_path = f'{target_file[:-len(".npy")]}.classes.json'
+    with open(classes_path, 'r') as reader:
+        classes = numpy.asarray(json.load(reader)[class_column])
+    y = classes[records[class_column]]
     return X, y
 
 
 def predict_character(config: dict, 
                       trained_classfier: object, 
                       image_path: str,
+                      columns: List[str] = None,
                       **executor_kwargs) -> None:
     logging.info('starting feature extraction...')
 
@@ -117,16 +181,20 @@ def predict_character(config: dict,
     if config.get('worker') == 'raw':
         features = extractor.run(dataset, image_path)
     else:
-        features = extractor.run(cv2.imread(image_path), dataset, None)
+        features = extractor.run(extractor.load_image(image_path), dataset, None)
 
     logging.debug('parsing extraction data...')
+
+    # values are dumped in the order of the output columns, following the class
+    names = [column['name'] for column in extractor.formatters[0].columns[1:]]
+    features = dict(zip(names, features.values()))
     
     display_table('Image Extracted Features', 
                   ['Feature', 'Percentage'], 
                   [[feat, format(number, '.2f')]
                    for feat, number in features.items()],)
 
-    X = [list(features.values())]
+    X = [list(features.values()) if columns is None else [features[name] for name in columns]]
     prediction = trained_classfier.predict_proba(X)
     matrix = [[trained_classfier.classes_[index], format(proba * 100, '.2f') + '%'] 
               for index, proba in enumerate(prediction[0])]
@@ -141,6 +209,8 @@ def run(args: argparse.Namespace):
     gnb = train(classifier, 
                 dataset_path,
                 print_confusion_matrix=args.confusion_matrix,
+                columns=args.columns,
+                rows=args.rows,
                 **config['classifier_kwargs'])
 
     if args.predict:
@@ -148,6 +218,7 @@ def run(args: argparse.Namespace):
         predict_character(config, 
                           gnb, 
                           image_path, 
+                          columns=args.columns,
                           max_workers=args.max_workers)
 
 
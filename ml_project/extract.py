@@ -11,15 +11,26 @@ from utils import (
     retrieve_pattern_method,
     show_available_methods,
 )
-from parallel import background_run, wait_futures
+from parallel import (
+    background_run, 
+    wait_futures, 
+    pipeline_futures, 
+    shutdown_executors,
+    scan_concurrently,
+    WorkerBudget,
+    AsyncioExecutor,
+    log_list,
+)
+from checkpoint import Journal
+from sink import OutputSink
 from patterns.base import BaseMethod
 import cv2
 
 from argparse import ArgumentParser, Namespace
-from typing import List, Tuple, Union, Callable, Any
+from typing import List, Tuple, Union, Callable, Any, Iterable, Iterator
+from contextlib import nullcontext
 from datetime import datetime
 import logging
-import json
 import sys
 import os
 
@@ -32,26 +43,90 @@ def parse_args() -> Namespace:
                         default=sys.stdout)
     parser.add_argument('-c', '--config', help='Configuration file', default='ml.json')
     parser.add_argument('-v', '--verbose', help='Be louder', action='store_true', default=False)
+    parser.add_argument('-w', '--max-workers', help='Total workers shared by all datasets, '
+                        'defaults to the number of cores', type=int, default=None)
+    parser.add_argument('-r', '--resume', help='Resume the interrupted run of this configuration',
+                        action='store_true', default=False)
     parser.add_argument('-l', '--list-methods', help='Lista all available pattern methods.',
                         action='store_true', default=False)
 
     return parser.parse_args()
 
 
-def with_image(path: str, dataset: dict, callback: Callable[[object, dict, str], Any]) -> None:
+def with_image(path: str, 
+               dataset: dict, 
+               callback: Callable[[object, dict, str], Any],
+               loader: Callable[[str], object] = cv2.imread) -> None:
     ''' 
     Wrapper function to execute a service callback with a loaded opencv image. 
     '''
 
-    image = cv2.imread(path)
+    image = loader(path)
 
     return callback(image, dataset, path)
 
 
+def with_images(paths: List[str], 
+                dataset: dict, 
+                callback: Callable[[list, dict, list], list],
+                loader: Callable[[str], object] = cv2.imread) -> List[Tuple[str, Any]]:
+    ''' 
+    Wrapper function to execute a service callback with a batch of loaded opencv images. 
+    Images that could not be loaded are paired with a None result.
+    '''
+
+    images, loaded_indexes = [], []
+    for index, path in enumerate(paths):
+        image = loader(path)
+        if image is not None:
+            images.append(image)
+            loaded_indexes.append(index)
+
+    results = [None] * len(paths)
+    if images:
+        loaded_paths = [paths[index] for index in loaded_indexes]
+        for index, result in zip(loaded_indexes, callback(images, dataset, loaded_paths)):
+            results[index] = result
+
+    return list(zip(paths, results))
+
+
+def with_loaded_image(image: object, 
+                      path: str, 
+                      dataset: dict, 
+                      callback: Callable[[object, dict, str], Any]) -> Any:
+    ''' 
+    Wrapper function to execute a service callback with an image prefetched by the pipeline. 
+    '''
+
+    return callback(image, dataset, path)
+
+
+def with_content(content: bytes,
+                 path: str, 
+                 dataset: dict, 
+                 callback: Callable[[object, dict, str], Any],
+                 decoder: Callable[[bytes, str], object]) -> Any:
+    ''' 
+    Wrapper function to execute a service callback with a file read by the 
+    asyncio backend, decoded in the worker process. 
+    '''
+
+    return callback(decoder(content, path), dataset, path)
+
+
 def raw_handler(path: str, dataset: dict, callback: Callable[[dict, str], Any]):
     return callback(dataset, path)
 
 
+def raw_content_handler(content: bytes,
+                        path: str,
+                        dataset: dict,
+                        callback: Callable[[dict, str, object], Any],
+                        decoder: Callable[[bytes, str], object]) -> Any:
+    return callback(dataset, path, decoder(content, path))
+
+
 def scan_directory(path: str) -> List[str]:
     ''' Get all file paths inside the given directory '''
 
@@ -70,66 +145,230 @@ def service_runner(worker: callable,
                    current_loop: int,
                    *args,
                    impl=None,
+                   journal: Journal = None,
+                   sink: OutputSink = None,
+                   partial: bool = False,
                    **executor_kwargs) -> Union[None, Tuple[int, List[str]]]:
-    ''' Scan targeted files in directory and try to convert them in parallel '''
+    ''' 
+    Scan targeted files in directory and try to convert them in parallel,
+    recording the slice in the journal once saved, through the sink when 
+    rows are sent to one. Slices of a split dataset save a partial only.
+    '''
 
     paths_count = len(paths)
     logging.debug('%s files found: %d', dataset_class, paths_count)
-    failed_items, results = wait_futures(worker, 
-                                        paths, 
-                                        dataset, 
-                                        method.run, 
-                                        mask_result=True,
-                                        impl=impl,
-                                        *args,
-                                        **executor_kwargs,)
+
+    if worker is with_images:
+        failed_items, results = batch_runner(worker,
+                                             dataset,
+                                             method,
+                                             paths,
+                                             *args,
+                                             impl=impl,
+                                             **executor_kwargs)
+    elif worker is with_loaded_image:
+        failed_items, results = pipeline_futures(method.load_image,
+                                                 worker,
+                                                 paths,
+                                                 dataset,
+                                                 method.run,
+                                                 mask_result=True,
+                                                 window=dataset.get('window'),
+                                                 **dataset['prefetch'],
+                                                 **executor_kwargs)
+    else:
+        callbacks = (method.run,)
+        if worker is with_image:
+            callbacks += (method.load_image,)
+        elif worker in (with_content, raw_content_handler):
+            callbacks += (method.decode,)
+
+        failed_items, results = wait_futures(worker, 
+                                            paths, 
+                                            dataset, 
+                                            *callbacks, 
+                                            mask_result=True,
+                                            impl=impl,
+                                            shared_arrays=use_shared_arrays(dataset, method),
+                                            chunk_size=dataset.get('chunk_size'),
+                                            window=dataset.get('window'),
+                                            *args,
+                                            **executor_kwargs,)
+
+    recording = nullcontext()
+    if sink is not None:
+        recording = sink.record(dataset_class, current_loop, paths)
 
     # save pattern result
-    save_pattern_method(dataset, method, results, current_loop)
+    with recording:
+        save_pattern_method(dataset, method, results, current_loop, partial=partial)
+
+    # without a sink, the method appends to no shared output
+    if sink is None and journal is not None:
+        journal.add(dataset_class, current_loop, paths, method.outputs)
 
     return (paths_count, failed_items)
 
 
-def create_service(config: dict, dataset: dict, *args, **kwargs) -> list:
-    ''' Create valid service configuration for running in the background '''
+def batch_runner(worker: callable,
+                 dataset: dict,
+                 method: BaseMethod,
+                 paths: list,
+                 *args,
+                 impl=None,
+                 **executor_kwargs) -> Tuple[List[str], list]:
+    ''' 
+    Feed chunks of paths to the method batch API in parallel. With a dataset
+    "window", results are a generator and failed items are complete once it 
+    is exhausted.
+    '''
 
-    if config.get('worker') == 'raw':
+    batch_size = dataset['batch_size']
+    chunks = [paths[index:index + batch_size] 
+              for index in range(0, len(paths), batch_size)]
+
+    logging.debug('%s split into %d batches of %d', 
+                  dataset['class'], 
+                  len(chunks), 
+                  batch_size)
+
+    # the window counts files, keep about as many in flight as batches
+    window = dataset.get('window') and max(1, dataset['window'] // batch_size)
+    failed_chunks, chunk_results = wait_futures(worker, 
+                                                chunks, 
+                                                dataset, 
+                                                method.run_batch, 
+                                                method.load_image,
+                                                mask_result=True,
+                                                impl=impl,
+                                                shared_arrays=use_shared_arrays(dataset, method),
+                                                chunk_size=dataset.get('chunk_size'),
+                                                window=window,
+                                                *args,
+                                                **executor_kwargs,)
+
+    failed_items = []
+    results = flatten_batches(failed_chunks, chunk_results, failed_items)
+    if not window:
+        results = list(results)
+    return failed_items, results
+
+
+def flatten_batches(failed_chunks: list, 
+                    chunk_results: Iterable, 
+                    failed_items: list) -> Iterator:
+    ''' Helper generator for the results of batches, collecting failed items '''
+
+    for chunk_result in chunk_results:
+        for path, result in chunk_result or []:
+            if result is None:
+                failed_items.append(path)
+            else:
+                yield result
+
+    # failed batches are only known once every result was handed over
+    for chunk in failed_chunks:
+        failed_items.extend(chunk)
+
+
+def use_shared_arrays(dataset: dict, method: BaseMethod) -> bool:
+    ''' Whether numpy results should cross processes through shared memory '''
+
+    return dataset.get('shared_arrays', method.options.get('shared_arrays', False))
+
+
+def create_service(config: dict, 
+                   dataset: dict, 
+                   max_workers: int,
+                   *args, 
+                   **kwargs) -> list:
+    ''' 
+    Create valid service configuration for running in the background, with
+    the workers granted to the dataset.
+    '''
+
+    if kwargs.get('impl') is AsyncioExecutor:
+        worker = raw_content_handler if config.get('worker') == 'raw' else with_content
+    elif config.get('worker') == 'raw':
         worker = raw_handler
+    elif dataset.get('batch_size'):
+        worker = with_images
+    elif dataset.get('prefetch'):
+        worker = with_loaded_image
     else:
         worker = with_image
 
     args = (worker, dataset, dataset['class'], *args)
     kwargs.update(**dataset.get('executor_kwargs', {}))
+    kwargs['max_workers'] = max_workers
     return ((args), kwargs)
 
 
 def save_pattern_method(dataset: dict, 
                         method: BaseMethod, 
                         results: list,
-                        index: int) -> None:
+                        index: int,
+                        partial: bool = False) -> None:
     target_name = parse_output_name(dataset, index)
-    method.save(target_name, results, dataset)
+    if partial:
+        method.save_partial(target_name, results, dataset)
+    else:
+        method.save(target_name, results, dataset)
     logging.info(f'patterns of {dataset["class"]} was saved sucessfully!')
 
 
-def run(config: dict) -> None:
+def run(config: dict, resume: bool = False) -> List[str]:
+    ''' Extract every dataset, returning the services of the slices which failed '''
+
     dataset_paths, splitted_datasets = {}, {}
 
-    for dataset in config['datasets']:
-        paths = scan_directory(dataset['path'])
+    method_factory = retrieve_pattern_method(config['method'])
+    method = method_factory(config=config.get('method_options', {}))
+    method.init(config['datasets'], resume=resume)
+
+    # slices of the "checkpoint" journal are skipped when resuming
+    journal, finished = None, {}
+    if config.get('checkpoint'):
+        journal = Journal(config['checkpoint'])
+        if resume:
+            finished = journal.resume(method.outputs)
+        else:
+            journal.start(method.outputs)
+
+    # a single writer appends the rows of every service to the outputs
+    sink = None
+    if method.outputs:
+        sink = OutputSink(method.outputs, journal)
+        method.write_to(sink)
+
+    directories = [dataset['path'] for dataset in config['datasets']]
+    if method.options.get('service_impl') is AsyncioExecutor:
+        all_paths = scan_concurrently(scan_directory, directories)
+    else:
+        all_paths = [scan_directory(directory) for directory in directories]
+
+    for dataset, paths in zip(config['datasets'], all_paths):
         if dataset.get('only'):
             paths = paths[:dataset.get('only')]
         dataset_paths[dataset['class']] = paths
 
-    method_factory = retrieve_pattern_method(config['method'])
-    method = method_factory(config=config.get('method_options', {}))
-    method.init(config['datasets'])
+    budget = WorkerBudget(config.get('max_workers'))
+    shares = [budget.clamp(dataset['class'],
+                           dataset.get('executor_kwargs', {}).get('max_workers'),
+                           share)
+              for dataset, share in zip(config['datasets'],
+                                        budget.shares(len(config['datasets'])))]
+    logging.info('worker budget: %d shared as %s', budget.total, shares)
 
-    global_index = 1
+    # slices of split datasets are summarized once every one is done
+    summarize = not method.options.get('ignore_split', False)
+
+    # slices are numbered by step, whatever the order in which they finish
+    global_index, services = 1, []
 
     while True:
-        services = []
-        for dataset in config['datasets']:
+        step_services = []
+        for dataset, share in zip(config['datasets'], shares):
             all_paths = dataset_paths[dataset['class']]
             step = dataset.get('step') or len(all_paths)
 
@@ -146,47 +385,79 @@ def run(config: dict) -> None:
                 # count how many splits
                 splitted_datasets[dataset['class']][1] += 1
 
-            if paths:
+            journaled_paths = finished.get((dataset['class'], global_index))
+            if paths and journaled_paths is not None:
+                if journaled_paths != paths:
+                    raise ValueError(f'{dataset["path"]} changed since the run to resume')
+                logging.info('skipping finished slice %d of [%s]', 
+                             global_index, 
+                             dataset['class'])
+            elif paths:
                 logging.info('remaining paths for [%s]: %d', 
                              dataset['class'], 
                              len(dataset_paths[dataset['class']]))
                 service = create_service(config, 
                                          dataset, 
+                                         share,
                                          method,
                                          paths, 
                                          global_index,
-                                         impl=method.options.get('service_impl'))
-                services.append(service)
+                                         impl=method.options.get('service_impl'),
+                                         journal=journal,
+                                         sink=sink,
+                                         partial=summarize and (
+                                             dataset['class'] in splitted_datasets))
+                step_services.append(service)
 
         # are we done?
-        if not services:
+        if not any(dataset_paths.values()) and not step_services:
             break
 
-        background_run(service_runner, 
-                       services,
-                       max_workers=config.get('max_workers'),
-                       impl=method.options.get('background_impl'))
-
+        services.extend(step_services)
         global_index += 1
 
-    if not method.options.get('ignore_split', False):
+    # every slice is queued at once, interleaved by step: an idle worker takes
+    # the next one of any dataset, so a slow slice never holds the others back
+    faileds = background_run(service_runner, 
+                             services,
+                             max_workers=budget.concurrency(len(config['datasets'])),
+                             impl=method.options.get('background_impl'))
+
+    # every step is done, release the workers kept alive between them
+    shutdown_executors()
+    if sink is not None:
+        sink.close()
+    method.report()
+
+    # failed slices are left to a resumed run, along with what depends on them
+    if faileds:
+        log_list('some slices have failed:', faileds)
+        if journal is not None:
+            logging.error('run again with --resume to extract them, journal: %s', journal.path)
+        return faileds
+
+    if summarize:
         finish_splitted_datasets(method, splitted_datasets)
 
+    if journal is not None:
+        journal.finish()
+    return []
+
 
 def finish_splitted_datasets(method: BaseMethod, 
                              splitted_datasets: dict) -> None:
     for dataset, count in splitted_datasets.values():
         logging.debug('recovering split stats for dataset: %s', dataset['class'])
-        all_stats = []
-        for index in range(1, count):
-            target_name = parse_output_name(dataset, index)
-            logging.debug('start reading stat: %s', target_name)
-            with open(target_name, 'r') as reader:
-                stats = json.load(reader)
-            all_stats.append(stats)
-            os.unlink(target_name)
-        all_stats = [list(stats) for stats in all_stats]
-        save_pattern_method(dataset, method, all_stats, 'summarized')
+
+        # the last slice is the one leaving no path behind
+        partial_paths = [method.partial_path(parse_output_name(dataset, index))
+                         for index in range(1, count + 2)]
+        method.summarize(parse_output_name(dataset, 'summarized'), partial_paths, dataset)
+        logging.info(f'patterns of {dataset["class"]} was saved sucessfully!')
+
+        # splits are only dropped once summarized, a resumed run may read them again
+        for partial_path in partial_paths:
+            os.unlink(partial_path)
 
 
 def main():
@@ -201,12 +472,22 @@ def main():
         return 0
 
     config = parse_config(args.config)
+    if args.max_workers:
+        config['max_workers'] = args.max_workers
+    config.setdefault('checkpoint', f'{args.config}.journal')
 
     start = datetime.now()
-    run(config)
+    try:
+        faileds = run(config, resume=args.resume)
+    except FileNotFoundError as error:
+        # a run killed before journaling anything has nothing to resume
+        if not args.resume or error.filename != config['checkpoint']:
+            raise
+        logging.error('%s: %s, run again without --resume', error.strerror, error.filename)
+        return 1
     logging.info('time spent: %s', datetime.now() - start)
 
-    return 0
+    return 1 if faileds else 0
 
 
 if __name__ == '__main__':
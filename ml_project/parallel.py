@@ -5,22 +5,129 @@
 This module exposes functions for running several services in the background.
 They all reside in the ThreadPoolExecutor implementation.
 
+A WorkerBudget shares one total of workers between the services running at once,
+and the AsyncioExecutor overlaps file reads for I/O heavy services.
+
+Executors are kept alive between calls, one for each role and configuration, 
+until shutdown_executors is called.
+
 '''
 
 from concurrent import futures
-from typing import List
+from multiprocessing import shared_memory, resource_tracker, util as multiprocessing_util
+from typing import List, Tuple, NamedTuple, Iterable, Iterator
+import numpy
+import asyncio
+import pickle
+import queue
+import threading
 import logging
+import math
+import time
+import os
+
+
+_executors, _executors_lock, _executors_finalizer = {}, threading.Lock(), None
+
+
+def _reset_executors() -> None:
+    ''' Forked processes can not use the executors of their parent '''
+
+    global _executors, _executors_lock, _executors_finalizer
+    _executors, _executors_lock, _executors_finalizer = {}, threading.Lock(), None
+
+
+os.register_at_fork(after_in_child=_reset_executors)
+
+
+def get_executor(role: str, impl: futures.Executor, **executor_kwargs) -> futures.Executor:
+    ''' 
+    Long-lived executor for a role, created on first use and reused until 
+    shutdown_executors or until it breaks. Roles keep nested work apart, so 
+    a task never waits on tasks queued behind it in the same executor.
+    '''
+
+    global _executors_finalizer
+
+    key = (role, impl, tuple(sorted(executor_kwargs.items())))
+    with _executors_lock:
+        if _executors_finalizer is None:
+            # exiting worker processes join their children before atexit, executors
+            # must go first, while multiprocessing queues (exitpriority 10) are open
+            _executors_finalizer = multiprocessing_util.Finalize(None,
+                                                                 shutdown_executors,
+                                                                 exitpriority=100)
+        # a worker killed while running breaks its pool for every later call
+        broken = _executors.get(key)
+        if broken is not None and getattr(broken, '_broken', False):
+            logging.warning('replacing broken %s executor %s', role, impl.__name__)
+            del _executors[key]
+            broken.shutdown(wait=False)
+
+        if key not in _executors:
+            executor = impl(**executor_kwargs)
+            logging.info('started %s executor %s with %s workers',
+                         role,
+                         impl.__name__,
+                         getattr(executor, '_max_workers', None))
+            _executors[key] = executor
+        return _executors[key]
+
+
+def shutdown_executors() -> None:
+    ''' Wait for every long-lived executor to finish and release its workers '''
+
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+
+    for executor in executors:
+        executor.shutdown()
+
 
+class WorkerBudget:
+    '''
+    Total number of workers shared by every service running at once, nested
+    executors included. Services get equal shares of it and requests above
+    their share are clamped, so the machine is never oversubscribed.
+    '''
 
-def background_run(runner: callable, 
+    def __init__(self, total: int = None):
+        self.total = max(1, total or os.cpu_count() or 1)
+
+    def concurrency(self, services_count: int) -> int:
+        ''' How many services may run at once, at least one worker each '''
+
+        return max(1, min(self.total, services_count))
+
+    def shares(self, services_count: int) -> List[int]:
+        ''' Workers of each service, services beyond concurrency wait for a free slot '''
+
+        base, extra = divmod(self.total, self.concurrency(services_count))
+        return [max(1, base + (index < extra)) for index in range(services_count)]
+
+    def clamp(self, name: str, requested: int, share: int) -> int:
+        if requested is None:
+            return share
+        if requested > share:
+            logging.warning('%s asked for %d workers, clamped to its share of %d out of %d',
+                            name,
+                            requested,
+                            share,
+                            self.total)
+            return share
+        return requested
+
+
+def background_run(runner: callable,
                    services: list,
                    impl: futures.Executor = None,
-                   max_workers: int = None) -> None:
-    ''' Execute services in parallel '''
+                   max_workers: int = None) -> List[str]:
+    ''' Execute services in parallel, returning those which failed '''
 
     if not services:
         logging.info('any available service to run in background, aborting...')
-        return
+        return []
 
     impl = impl or futures.ProcessPoolExecutor
 
@@ -30,10 +137,10 @@ def background_run(runner: callable,
 
     logging.debug('starting background run for services: %s', services)
 
-    with impl(max_workers=max_workers) as executor:
-        future_to_service = {executor.submit(runner, *args, **kwargs): args[2]
-                             for args, kwargs in services}
-        display_service_futures(future_to_service)
+    executor = get_executor('background', impl, max_workers=max_workers)
+    future_to_service = {executor.submit(runner, *args, **kwargs): args[2]
+                         for args, kwargs in services}
+    return display_service_futures(future_to_service)
 
 
 def handle_futures(future_to_service: dict) -> None:
@@ -54,37 +161,536 @@ def wait_futures(worker: callable,
                  *args,
                  show_status: bool = True,
                  mask_result: bool = False,
-                 impl: futures.Executor = None,
-                 **executor_kwargs) -> List[str]:
-    ''' Manage parallel tasks with nice logging '''
+                 window: int = None,
+                 **kwargs) -> Tuple[List[str], Iterable]:
+    ''' 
+    Manage parallel tasks with nice logging, see iter_futures for the other
+    arguments.
+
+    With a "window", results are handed over as a generator in completion
+    order and at most "window" services are in flight, so memory does not 
+    grow with the number of services. Failed services are only all known 
+    once the generator is exhausted.
+    '''
+
+    faileds = []
+    results = log_futures(iter_futures(worker, services, *args, window=window, **kwargs),
+                          len(services),
+                          faileds,
+                          show_status=show_status,
+                          mask_result=mask_result)
+    if window:
+        return faileds, results
+    return faileds, list(results)
 
-    impl = impl or futures.ProcessPoolExecutor
 
-    index, faileds, results = 0, [], []
-    if show_status:
-        services_count = len(services)
-    with impl(**executor_kwargs) as executor:
-        future_to_service = {executor.submit(worker, service, *args): service
-                             for service in services}
-        for service, result, error in handle_futures(future_to_service):
+def log_futures(completed_chunks: Iterable,
+                services_count: int,
+                faileds: list,
+                show_status: bool = True,
+                mask_result: bool = False) -> Iterator:
+    ''' Helper generator for logging completed chunks, collecting failed services '''
+
+    index = 0
+    for chunk in completed_chunks:
+        succeeded = 0
+        for service, result, error in chunk:
             if error:
                 logging.error('%s exited with: %s', service, error)
             elif not mask_result:
                 logging.debug('%s resulted in: %s', service, result)
 
-            results.append(result)
-            success = result is not None
-            if not success:
+            if result is None:
                 faileds.append(service)
+            else:
+                succeeded += 1
+            yield result
+
+        index += len(chunk)
+
+        if show_status:
+            logging.info('fineshed chunk: %d items success: %d status: %s',
+                        len(chunk),
+                        succeeded,
+                        f'{index}/{services_count}')
+
+
+def iter_futures(worker: callable,
+                 services: list,
+                 *args,
+                 impl: futures.Executor = None,
+                 shared_arrays: bool = False,
+                 chunk_size: int = None,
+                 window: int = None,
+                 **executor_kwargs) -> Iterator[List[Tuple[object, object, Exception]]]:
+    ''' 
+    Run "worker(service, *args)" for every service, yielding completed chunks
+    of (service, result, error) in completion order.
+
+    Services are sent to the executor in chunks, a single task each, and their
+    results come back together. Unless a fixed "chunk_size" is given, chunks
+    are sized by ChunkSizer from the measured time per item. A "window" bounds
+    the services in flight, otherwise a couple of chunks per worker are.
+
+    With "shared_arrays", numpy services and results cross process boundaries 
+    through shared memory instead of being pickled. When debugging, the average
+    pickled bytes per item sent to and received from processes are logged.
+    '''
+
+    impl = impl or futures.ProcessPoolExecutor
+
+    # threads share memory already, only processes need a transport
+    in_process = issubclass(impl, futures.ThreadPoolExecutor)
+    shared_arrays = shared_arrays and not in_process
+    measure_ipc = not in_process and logging.getLogger().isEnabledFor(logging.DEBUG)
+    sent_bytes, received_bytes = 0, 0
+
+    position, in_flight = 0, 0
+    services_count = len(services)
+    executor = get_executor('service', impl, **executor_kwargs)
+    if isinstance(executor, AsyncioExecutor):
+        yield from executor.map_files(worker, services, *args, window=window)
+        return
+
+    workers = getattr(executor, '_max_workers', None) or 1
+    sizer = ChunkSizer(workers, chunk_size)
+
+    future_to_chunk = {}
+    try:
+        while position < services_count or future_to_chunk:
+            # sizes follow the latest measures, so only a few chunks are queued ahead
+            while position < services_count and \
+                    len(future_to_chunk) < workers * ChunkSizer.chunks_per_worker:
+                size = sizer.next_size(services_count - position)
+                if window:
+                    size = min(size, window)
+                    if future_to_chunk and in_flight + size > window:
+                        break
+
+                chunk = services[position:position + size]
+                position += len(chunk)
+                in_flight += len(chunk)
+
+                payload = [share_array(service) for service in chunk] if shared_arrays else chunk
+                call = (run_chunk, worker, payload, shared_arrays, *args)
+                if measure_ipc:
+                    sent_bytes += len(pickle.dumps(call))
+                try:
+                    future_to_chunk[executor.submit(*call)] = (chunk, payload)
+                except Exception:
+                    if shared_arrays:
+                        for value in payload:
+                            release_array(value)
+                    raise
+
+            done, _ = futures.wait(future_to_chunk, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                chunk, payload = future_to_chunk.pop(future)
+                in_flight -= len(chunk)
+                try:
+                    chunk_results, seconds = future.result()
+                    sizer.update(len(chunk), seconds)
+                except Exception as exception:  # pylint: disable=broad-except
+                    chunk_results = [(None, exception)] * len(chunk)
+                    if shared_arrays:
+                        for value in payload:
+                            release_array(value)
+
+                if measure_ipc:
+                    received_bytes += len(pickle.dumps(chunk_results))
+
+                if shared_arrays:
+                    chunk_results = [(attach_array(result), error) 
+                                     for result, error in chunk_results]
+
+                yield [(service, result, error) 
+                       for service, (result, error) in zip(chunk, chunk_results)]
+    finally:
+        # chunks left behind by a dropped generator or a broken pool still hold
+        # shared memory, only taken back by the other side otherwise
+        if shared_arrays:
+            for future, (_, payload) in future_to_chunk.items():
+                discard_chunk(future, payload)
+
+    if measure_ipc and services_count:
+        logging.debug('ipc pickled bytes per item: sent %d received %d',
+                      sent_bytes / services_count,
+                      received_bytes / services_count)
+
+
+def run_chunk(worker: callable, 
+              chunk: list, 
+              shared_arrays: bool, 
+              *args) -> Tuple[List[Tuple[object, Exception]], float]:
+    ''' 
+    Run a worker on every service of a chunk inside the executor, returning 
+    a (result, error) pair for each one and the seconds spent on the chunk.
+    '''
+
+    started = time.monotonic()
+    results = []
+    for service in chunk:
+        result, error = None, None
+        try:
+            if shared_arrays:
+                result = share_array(worker(attach_array(service), *args))
+            else:
+                result = worker(service, *args)
+        except Exception as exception:  # pylint: disable=broad-except
+            error = exception
+        results.append((result, error))
+    return results, time.monotonic() - started
+
+
+class ChunkSizer:
+    '''
+    Chunk sizes making each chunk last about "duration" seconds of work, so
+    dispatching and pickling become small next to it. The first chunks hold a
+    single item until their time per item is measured, and chunks stay small
+    enough to give every worker a few of them at the tail of the run.
+    '''
+
+    chunks_per_worker = 2
+
+    def __init__(self, workers: int, chunk_size: int = None, duration: float = 0.2):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.duration = duration
+        self.item_seconds = None
+
+    def update(self, items_count: int, seconds: float) -> None:
+        item_seconds = seconds / max(items_count, 1)
+        if self.item_seconds is None:
+            self.item_seconds = item_seconds
+        else:
+            # moving average, a slow item does not reset the size on its own
+            self.item_seconds = 0.8 * self.item_seconds + 0.2 * item_seconds
+
+    def next_size(self, remaining: int) -> int:
+        if self.chunk_size:
+            return self.chunk_size
+        if self.item_seconds is None:
+            return 1
+
+        size = int(self.duration / max(self.item_seconds, 1e-6))
+        balanced = math.ceil(remaining / (self.workers * self.chunks_per_worker))
+        return max(1, min(size, balanced))
+
+
+class AsyncioExecutor(futures.Executor):
+    '''
+    Executor for I/O heavy services: files are read on an asyncio event loop
+    while the CPU-bound work runs on a small process pool, so a few workers 
+    overlap many reads instead of hundreds of threads. Calls submitted 
+    directly go straight to the process pool.
+
+    Regular files have no non-blocking API, so the loop reads them through 
+    "io_workers" threads, at most "io_concurrency" files being in flight.
+    '''
 
-            index += 1
+    io_workers = 4
+    io_concurrency = 64
 
-            if show_status:
-                logging.info('fineshed: %s success: %s status: %s',
-                            service,
-                            success,
-                            f'{index}/{services_count}')
-    return faileds, results
+    def __init__(self, max_workers: int = None):
+        self._pool = futures.ProcessPoolExecutor(max_workers=max_workers)
+        self._io = futures.ThreadPoolExecutor(max_workers=self.io_workers)
+        self._max_workers = self._pool._max_workers  # pylint: disable=protected-access
+
+    @property
+    def _broken(self) -> bool:
+        return self._pool._broken  # pylint: disable=protected-access
+
+    def submit(self, fn, /, *args, **kwargs) -> futures.Future:
+        return self._pool.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        self._pool.shutdown(wait=wait, cancel_futures=cancel_futures)
+        self._io.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+    def map_files(self, 
+                  worker: callable, 
+                  paths: list, 
+                  *args, 
+                  window: int = None) -> Iterator[List[Tuple[str, object, Exception]]]:
+        ''' 
+        Read every path and run "worker(content, path, *args)" on the process
+        pool, yielding completed (path, result, error) in completion order.
+        '''
+
+        window = window or self.io_concurrency
+
+        # a loop for each call, services of a threaded background may share the executor
+        loop = asyncio.new_event_loop()
+
+        async def process(path: str) -> object:
+            content = await loop.run_in_executor(self._io, read_file, path)
+            return await loop.run_in_executor(self._pool, worker, content, path, *args)
+
+        position, task_to_path = 0, {}
+        try:
+            while position < len(paths) or task_to_path:
+                while position < len(paths) and len(task_to_path) < window:
+                    task_to_path[loop.create_task(process(paths[position]))] = paths[position]
+                    position += 1
+
+                done, _ = loop.run_until_complete(asyncio.wait(task_to_path, 
+                                                               return_when=asyncio.FIRST_COMPLETED))
+                completed = []
+                for task in done:
+                    error = task.exception()
+                    completed.append((task_to_path.pop(task), 
+                                      None if error else task.result(), 
+                                      error))
+                yield completed
+        finally:
+            for task in task_to_path:
+                task.cancel()
+            if task_to_path:
+                loop.run_until_complete(asyncio.gather(*task_to_path, return_exceptions=True))
+            loop.close()
+
+
+def read_file(path: str) -> bytes:
+    with open(path, 'rb') as reader:
+        return reader.read()
+
+
+def scan_concurrently(scan: callable, 
+                      paths: list, 
+                      io_workers: int = AsyncioExecutor.io_workers) -> list:
+    ''' Run a blocking directory scan for several paths at once on an event loop '''
+
+    async def gather():
+        loop = asyncio.get_running_loop()
+        with futures.ThreadPoolExecutor(max_workers=io_workers) as io_executor:
+            return await asyncio.gather(*(loop.run_in_executor(io_executor, scan, path) 
+                                          for path in paths))
+
+    return asyncio.run(gather())
+
+
+class SharedArray(NamedTuple):
+    '''Handle of a numpy array stored in a shared memory block.'''
+
+    name: str
+    shape: tuple
+    dtype: str
+
+
+def share_array(value: object) -> object:
+    ''' Move a numpy array into shared memory, other values are returned untouched '''
+
+    if not isinstance(value, numpy.ndarray):
+        return value
+
+    memory = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+    numpy.ndarray(value.shape, dtype=value.dtype, buffer=memory.buf)[...] = value
+    memory.close()
+
+    # the receiver owns the segment from now on, attach_array unlinks it
+    resource_tracker.unregister(memory._name, 'shared_memory')  # pylint: disable=protected-access
+    return SharedArray(memory.name, value.shape, value.dtype.str)
+
+
+def attach_array(value: object) -> object:
+    ''' Take back an array moved by share_array, releasing its shared memory '''
+
+    if not isinstance(value, SharedArray):
+        return value
+
+    memory = shared_memory.SharedMemory(name=value.name)
+    try:
+        return numpy.ndarray(value.shape, dtype=value.dtype, buffer=memory.buf).copy()
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+def release_array(value: object) -> None:
+    ''' Free an array moved by share_array which will not be taken back '''
+
+    if not isinstance(value, SharedArray):
+        return
+
+    try:
+        memory = shared_memory.SharedMemory(name=value.name)
+    except FileNotFoundError:
+        # already taken back by the other side
+        return
+    memory.close()
+    memory.unlink()
+
+
+def discard_chunk(future: futures.Future, payload: list) -> None:
+    ''' Free the shared arrays of a chunk whose results are not wanted anymore '''
+
+    if not future.cancel():
+        try:
+            chunk_results, _ = future.result()
+        except Exception:  # pylint: disable=broad-except
+            chunk_results = []
+        for result, _ in chunk_results:
+            release_array(result)
+
+    for value in payload:
+        release_array(value)
+
+
+def pipeline_futures(loader: callable,
+                     worker: callable,
+                     services: list,
+                     *args,
+                     show_status: bool = True,
+                     mask_result: bool = False,
+                     window: int = None,
+                     **kwargs) -> Tuple[List[str], Iterable]:
+    ''' 
+    Manage a loading pipeline with nice logging, see iter_pipeline for the 
+    other arguments.
+
+    With a "window", results are handed over as a generator in completion
+    order and at most "window" services are loaded or run at once, as in 
+    wait_futures.
+    '''
+
+    faileds = []
+    results = log_pipeline(iter_pipeline(loader, worker, services, *args, window=window, **kwargs),
+                           len(services),
+                           faileds,
+                           show_status=show_status,
+                           mask_result=mask_result)
+    if window:
+        return faileds, results
+    return faileds, list(results)
+
+
+def log_pipeline(completed: Iterable,
+                 services_count: int,
+                 faileds: list,
+                 show_status: bool = True,
+                 mask_result: bool = False) -> Iterator:
+    ''' Helper generator for logging completed services, collecting failed ones '''
+
+    for index, (service, result, error) in enumerate(completed, start=1):
+        if error:
+            logging.error('%s exited with: %s', service, error)
+        elif not mask_result:
+            logging.debug('%s resulted in: %s', service, result)
+
+        success = result is not None
+        if not success:
+            faileds.append(service)
+
+        if show_status:
+            logging.info('fineshed: %s success: %s status: %s',
+                        service,
+                        success,
+                        f'{index}/{services_count}')
+        yield result
+
+
+def iter_pipeline(loader: callable,
+                  worker: callable,
+                  services: list,
+                  *args,
+                  queue_size: int = 32,
+                  io_workers: int = 4,
+                  max_workers: int = None,
+                  window: int = None) -> Iterator[Tuple[object, object, Exception]]:
+    ''' 
+    Run services in two stages connected by a bounded queue: "io_workers" threads
+    load each service with "loader" and prefetch up to "queue_size" items, while 
+    "max_workers" threads call "worker(loaded, service, *args)" on them. 
+    (service, result, error) entries are yielded in completion order, with no
+    more than "window" services loaded or run ahead of them if given.
+    '''
+
+    max_workers = max_workers or 1
+    prefetched = queue.Queue(maxsize=queue_size)
+    stats = dict(io_busy=0.0, io_blocked=0.0, compute_busy=0.0, compute_starved=0.0)
+    lock = threading.Lock()
+
+    def account(**elapsed):
+        with lock:
+            for stat, seconds in elapsed.items():
+                stats[stat] += seconds
+
+    def load(service):
+        started = time.monotonic()
+        loaded, error = None, None
+        try:
+            loaded = loader(service)
+        except Exception as exception:  # pylint: disable=broad-except
+            error = exception
+        loaded_at = time.monotonic()
+        prefetched.put((service, loaded, error))
+        account(io_busy=loaded_at - started, io_blocked=time.monotonic() - loaded_at)
+
+    def consume():
+        while True:
+            started = time.monotonic()
+            entry = prefetched.get()
+            got_at = time.monotonic()
+            account(compute_starved=got_at - started)
+            if entry is None:
+                return
+
+            service, loaded, error = entry
+            result = None
+            if error is None:
+                try:
+                    result = worker(loaded, service, *args)
+                except Exception as exception:  # pylint: disable=broad-except
+                    error = exception
+            account(compute_busy=time.monotonic() - got_at)
+            done.put((service, result, error))
+
+    done = queue.Queue()
+
+    # loaders block on the queue of their own pipeline, so these pools are not shared
+    with futures.ThreadPoolExecutor(max_workers=io_workers) as io_executor, \
+            futures.ThreadPoolExecutor(max_workers=max_workers) as compute_executor:
+        for _ in range(max_workers):
+            compute_executor.submit(consume)
+
+        submitted, index, services_count = 0, 0, len(services)
+        try:
+            while index < services_count:
+                while submitted < services_count and \
+                        (not window or submitted - index < window):
+                    io_executor.submit(load, services[submitted])
+                    submitted += 1
+
+                index += 1
+                yield done.get()
+        finally:
+            # loads not started are dropped when the results are not wanted
+            # anymore, the started ones are consumed before compute workers stop
+            io_executor.shutdown(cancel_futures=True)
+            for _ in range(max_workers):
+                prefetched.put(None)
+
+    display_pipeline_stats(stats)
+
+
+def display_pipeline_stats(stats: dict) -> None:
+    ''' Helper function to display where the pipeline stages spent their time '''
+
+    io_total = (stats['io_busy'] + stats['io_blocked']) or 1
+    compute_total = (stats['compute_busy'] + stats['compute_starved']) or 1
+    io_blocked = stats['io_blocked'] / io_total
+    compute_starved = stats['compute_starved'] / compute_total
+
+    # starving compute means loading can not keep up, blocked loaders mean the opposite
+    bottleneck = 'io' if compute_starved > io_blocked else 'compute'
+
+    logging.info('pipeline io busy: %.2fs blocked: %d%% compute busy: %.2fs '
+                 'starved: %d%% bottleneck: %s',
+                 stats['io_busy'],
+                 io_blocked * 100,
+                 stats['compute_busy'],
+                 compute_starved * 100,
+                 bottleneck)
 
 
 def display_status(name: str, total: int, items_failed: list) -> None:
@@ -109,15 +715,19 @@ def log_list(header: str, content: list) -> None:
     logging.warning('\n'.join([header] + placeholder), *content)
 
 
-def display_service_futures(future_to_service: dict):
-    ''' Helper function to display fineshed services '''
+def display_service_futures(future_to_service: dict) -> List[str]:
+    ''' Helper function to display fineshed services, returning the failed ones '''
 
+    faileds = []
     for service, result, error in handle_futures(future_to_service):
         if error:
             logging.error('%s service exited with: %s', service, error)
+            faileds.append(service)
         elif result:
             display_status(service, *result)
         else:
             logging.info('no %s files found', service)
 
         logging.info('service fineshed: %s', service)
+
+    return faileds
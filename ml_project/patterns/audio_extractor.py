@@ -2,27 +2,201 @@ from .base import BaseMethod
 from .features_extractor import (
     CsvFormat, 
     ArffFormat, 
+    NpyFormat,
     NullFormatter
 )
-from parallel import wait_futures
+from .cache import (
+    FeatureCache, 
+    CachedFeatures, 
+    PcmCache,
+    feature_cache, 
+    pcm_cache,
+    config_digest
+)
+from parallel import wait_futures, AsyncioExecutor
+import soundfile
 import librosa
 import numpy
 
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
 from concurrent.futures import ThreadPoolExecutor
-from typing import Any
 from collections import Counter
+from functools import cached_property
+import inspect
 import logging
+import io
+
+
+# STFT of every feature, librosa defaults
+N_FFT, HOP_LENGTH = 2048, 512
+PAD_MODE = inspect.signature(librosa.stft).parameters['pad_mode'].default
+TOP_DB = 80.0
+
+
+class Spectra:
+    '''
+    Time-frequency transforms of a clip, each computed once and shared by the 
+    features derived from it: the STFT magnitude feeds the spectral contrast, 
+    its power the mel spectrogram of the MFCCs and the STFT chroma.
+    '''
+
+    def __init__(self, data: numpy.ndarray, sr: int):
+        self.data, self.sr = data, sr
+
+    @cached_property
+    def magnitude(self) -> numpy.ndarray:
+        return numpy.abs(librosa.stft(self.data))
+
+    @cached_property
+    def power(self) -> numpy.ndarray:
+        return self.magnitude ** 2
+
+    @cached_property
+    def mel(self) -> numpy.ndarray:
+        return librosa.feature.melspectrogram(S=self.power, sr=self.sr)
+
+    def chroma(self, method: str = 'cqt') -> numpy.ndarray:
+        if method == 'cqt':
+            return librosa.feature.chroma_cqt(y=self.data, sr=self.sr)
+        if method == 'stft':
+            return librosa.feature.chroma_stft(S=self.power, sr=self.sr)
+        raise ValueError(f'Unknown chroma "{method}".')
+
+    def spectral_contrast(self) -> numpy.ndarray:
+        return librosa.feature.spectral_contrast(S=self.magnitude, sr=self.sr)
+
+    def mfcc(self) -> numpy.ndarray:
+        return librosa.feature.mfcc(S=librosa.power_to_db(self.mel), sr=self.sr)
+
+
+def framed_blocks(blocks: Iterable[numpy.ndarray]) -> Iterator[numpy.ndarray]:
+    '''
+    Cut the blocks of a signal so that librosa.stft(block, center=False) of 
+    each gives the next frames of librosa.stft(signal), ends padded alike.
+    '''
+
+    pad = N_FFT // 2
+    buffer, started = numpy.zeros(0, dtype=numpy.float32), False
+    for block in blocks:
+        buffer = numpy.concatenate((buffer, block))
+
+        # reflecting the start takes the samples following it
+        if not started:
+            if len(buffer) <= pad:
+                continue
+            buffer, started = numpy.pad(buffer, (pad, 0), mode=PAD_MODE), True
+
+        # the samples left over always hold those reflected by the end
+        frames = (len(buffer) - N_FFT) // HOP_LENGTH + 1
+        if frames > 0:
+            yield buffer[:(frames - 1) * HOP_LENGTH + N_FFT]
+            buffer = buffer[frames * HOP_LENGTH:]
+
+    if not started:
+        buffer = numpy.pad(buffer, (pad, 0), mode=PAD_MODE)
+    buffer = numpy.pad(buffer, (0, pad), mode=PAD_MODE)
+    frames = (len(buffer) - N_FFT) // HOP_LENGTH + 1
+    if frames > 0:
+        yield buffer[:(frames - 1) * HOP_LENGTH + N_FFT]
+
 
+def contrast_bands(magnitude: numpy.ndarray, 
+                   sr: int, 
+                   fmin: float = 200.0, 
+                   n_bands: int = 6, 
+                   quantile: float = 0.02) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    '''
+    Peaks and valleys of the bands of librosa.feature.spectral_contrast, whose
+    contrast is the difference of their decibels.
+    '''
 
-def _parse_mfcc(data, sr=None):
-    mfcc = librosa.feature.mfcc(data, sr=sr)
-    return list(map(numpy.mean, mfcc))
+    freq = librosa.fft_frequencies(sr=sr, n_fft=N_FFT)
+    octa = numpy.zeros(n_bands + 2)
+    octa[1:] = fmin * (2.0 ** numpy.arange(0, n_bands + 1))
+
+    valley = numpy.zeros((n_bands + 1, magnitude.shape[1]))
+    peak = numpy.zeros_like(valley)
+    for k, (f_low, f_high) in enumerate(zip(octa[:-1], octa[1:])):
+        current_band = numpy.logical_and(freq >= f_low, freq <= f_high)
+
+        idx = numpy.flatnonzero(current_band)
+        if k > 0:
+            current_band[idx[0] - 1] = True
+        if k == n_bands:
+            current_band[idx[-1] + 1:] = True
+
+        sub_band = magnitude[current_band]
+        if k < n_bands:
+            sub_band = sub_band[:-1]
+
+        idx = int(numpy.maximum(numpy.rint(quantile * numpy.sum(current_band)), 1))
+        sortedr = numpy.sort(sub_band, axis=0)
+        valley[k] = numpy.mean(sortedr[:idx], axis=0)
+        peak[k] = numpy.mean(sortedr[-idx:], axis=0)
+    return peak, valley
+
+
+class SpectraStream:
+    '''
+    Means of the features of Spectra over a clip read by blocks, holding a 
+    single block at a time.
+
+    Decibels are clipped "top_db" below the loudest value of the whole clip,
+    so a first pass over the blocks finds those values and a second one sums
+    the features of every frame. The chroma is derived from the STFT, tuned 
+    as estimated on the first block unless given.
+    '''
+
+    def __init__(self, 
+                 blocks: Callable[[], Iterable[numpy.ndarray]], 
+                 sr: int, 
+                 tuning: float = None):
+        self.blocks, self.sr, self.tuning = blocks, sr, tuning
+
+    def spectra(self) -> Iterator[Tuple[numpy.ndarray, numpy.ndarray]]:
+        ''' Magnitude and power of the frames of every block '''
+
+        for block in framed_blocks(self.blocks()):
+            magnitude = numpy.abs(librosa.stft(block, center=False))
+            yield magnitude, magnitude ** 2
+
+    def decibels(self, magnitude: numpy.ndarray, power: numpy.ndarray) -> Tuple[numpy.ndarray, ...]:
+        ''' Unclipped decibels of the mel spectrogram, contrast peaks and valleys '''
+
+        mel = librosa.feature.melspectrogram(S=power, sr=self.sr)
+        peak, valley = contrast_bands(magnitude, self.sr)
+        return tuple(librosa.power_to_db(values, top_db=None) for values in (mel, peak, valley))
+
+    def means(self) -> Tuple[float, float, numpy.ndarray]:
+        ''' Mean chroma, spectral contrast and MFCCs of the clip '''
+
+        loudest, tuning = None, self.tuning
+        for magnitude, power in self.spectra():
+            maxima = [values.max() for values in self.decibels(magnitude, power)]
+            loudest = maxima if loudest is None else numpy.maximum(loudest, maxima)
+            if tuning is None:
+                tuning = librosa.estimate_tuning(S=power, sr=self.sr, bins_per_octave=12)
+        floors = numpy.asarray(loudest) - TOP_DB
+
+        chroma, contrast, log_mel, frames = 0.0, 0.0, 0.0, 0
+        for magnitude, power in self.spectra():
+            mel, peak, valley = (numpy.maximum(values, floor) 
+                                 for values, floor in zip(self.decibels(magnitude, power), floors))
+            chroma += librosa.feature.chroma_stft(S=power, sr=self.sr, tuning=tuning).sum()
+            contrast += (peak - valley).sum()
+            log_mel = log_mel + mel.sum(axis=1, dtype=numpy.float64)
+            frames += power.shape[1]
+
+        # the MFCCs are linear in the log mel spectrogram, so are their means
+        mfcc = librosa.feature.mfcc(S=(log_mel / frames)[:, None], sr=self.sr)[:, 0]
+        return chroma / (12 * frames), contrast / (len(peak) * frames), mfcc
 
 
 class AudioExtractor(BaseMethod):
     available_formatters = {
         'arff': ArffFormat,
         'csv': CsvFormat,
+        'npy': NpyFormat,
         'null': NullFormatter
     }
 
@@ -30,7 +204,7 @@ class AudioExtractor(BaseMethod):
         super().__init__(*args, **kwargs)
         self.path, self.formatters = None, []
 
-    def init(self, datasets: list) -> None:
+    def init(self, datasets: list, resume: bool = False) -> None:
         self.path = self.config['feature']['output']
 
         classes = []
@@ -48,9 +222,16 @@ class AudioExtractor(BaseMethod):
         else:
             format_classes = [self.available_formatters[out_format]]
 
-        self.formatters = [klass(self.path, columns, **self.config['feature']) 
+        self.formatters = [klass(self.path, columns, resume=resume, **self.config['feature']) 
                            for klass in format_classes]
 
+        if self.cache is not None:
+            self.cache.reset_stats()
+
+        if self.stream is not None and self.config['feature'].get('chroma', 'cqt') != 'stft':
+            raise ValueError('Streamed audio derives the chroma from the STFT, '
+                             'set "chroma": "stft" in the feature configuration.')
+
     @property
     def available_feature_names(self) -> list:
         defaults = ['cqt', 'spct_contrast']
@@ -62,29 +243,189 @@ class AudioExtractor(BaseMethod):
     def description(self) -> str:            
         return 'Extracts pre-defined audio features.'
 
+    @property
+    def outputs(self) -> List[str]:
+        return [formatter.path for formatter in self.formatters if formatter.extension]
+
+    @property
+    def cache(self) -> FeatureCache:
+        '''Cache of the optional "cache" entry of the feature configuration.'''
+
+        return feature_cache(self.config['feature'])
+
+    @property
+    def cache_digest(self) -> str:
+        '''Digest of the feature configuration, leaving out where results and caches are written.'''
+
+        ignored = ('output', 'relation_name', 'format', 'cache')
+        content = {key: value for key, value in self.config['feature'].items() 
+                   if key not in ignored}
+        if 'decode' in content:
+            content['decode'] = self.decode_digest
+        return config_digest(content)
+
+    @property
+    def stream(self) -> dict:
+        '''The "stream" entry of the feature configuration, true for its defaults.'''
+
+        stream = self.config['feature'].get('stream')
+        if stream is None or stream is False:
+            return None
+        return {} if stream is True else stream
+
+    @property
+    def pcm_cache(self) -> PcmCache:
+        '''Cache of decoded audio, the "cache" entry of the "decode" configuration.'''
+
+        return pcm_cache(self.config['feature'].get('decode') or {})
+
+    @property
+    def decode_digest(self) -> str:
+        decode = self.config['feature'].get('decode') or {}
+        return config_digest({key: value for key, value in decode.items() if key != 'cache'})
+
+    def write_to(self, sink: Any) -> None:
+        for formatter in self.formatters:
+            formatter.sink = sink
+            sink.after_flush(formatter.path, formatter.flushed)
+
+    def report(self) -> None:
+        if self.cache is not None:
+            self.cache.report()
+
     @property
     def options(self) -> dict:
         return {
             'ignore_split': True,
-            'service_impl': ThreadPoolExecutor,
+            # streamed files are read by blocks, not by the asyncio backend
+            'service_impl': AsyncioExecutor if self.stream is None else ThreadPoolExecutor,
         }
 
-    def run(self, dataset: dict, path: str) -> None:
-        '''Callback to extract feature from image.'''
+    def decode(self, content: bytes, path: str) -> Tuple[numpy.ndarray, int]:
+        '''Decode an audio file read by the asyncio backend.'''
+
+        cached = self._cached_audio(path)
+        if cached is not None:
+            return cached
 
-        data, sr = librosa.load(path)
-        cqt = librosa.feature.chroma_cqt(data, sr=sr)
-        spct_contrast = librosa.feature.spectral_contrast(data, sr=sr) 
+        return self.load_audio(path, io.BytesIO(content))
+
+    def load_audio(self, path: str, source: Any = None) -> Tuple[numpy.ndarray, int]:
+        '''
+        Decode an audio, from source when given, following the optional 
+        "decode" entry of the feature configuration:
+         - "sample_rate": rate to resample to, 22050 by default, or "native" to
+           keep the rate of the file.
+         - "resample": resampler to use, as librosa "res_type" values.
+         - "backend": "soundfile" decodes straight to float32 samples, 
+           "librosa" (default) through librosa.load.
+         - "cache": decoded samples are kept as in the feature cache, so 
+           extracting again skips decoding.
+        '''
+
+        cache = self.pcm_cache
+        if cache is not None:
+            cached = cache.lookup(path, self.decode_digest)
+            if cached is not None:
+                return cached
+
+        decode = self.config['feature'].get('decode') or {}
+        source = path if source is None else source
+        sr = decode.get('sample_rate', 22050)
+        sr = None if sr == 'native' else sr
+        resample = {'res_type': decode['resample']} if decode.get('resample') else {}
+
+        if decode.get('backend', 'librosa') == 'soundfile':
+            data, native_sr = soundfile.read(source, dtype='float32', always_2d=True)
+            data = data[:, 0] if data.shape[1] == 1 else data.mean(axis=1)
+            if sr is not None and sr != native_sr:
+                data = librosa.resample(data, orig_sr=native_sr, target_sr=sr, **resample)
+            else:
+                sr = native_sr
+        else:
+            try:
+                data, sr = librosa.load(source, sr=sr, **resample)
+            except RuntimeError:
+                # librosa falls back to audioread for paths only, as for formats libsndfile lacks
+                if source is path:
+                    raise
+                data, sr = librosa.load(path, sr=sr, **resample)
+
+        if cache is not None:
+            cache.store(path, self.decode_digest, data, sr)
+        return data, sr
+
+    def stream_audio(self, path: str) -> SpectraStream:
+        '''
+        Read an audio by blocks following the "stream" entry of the feature 
+        configuration, decoded through soundfile as set by the "decode" entry:
+         - "block_size": samples of the file read at once, 262144 by default.
+         - "tuning": chroma tuning, estimated on the first block by default.
+
+        Features are the same as when decoding whole files at their sample 
+        rate, blocks resampled to another one may differ at their edges.
+        '''
+
+        stream = self.stream
+        decode = self.config['feature'].get('decode') or {}
+        native_sr = soundfile.info(path).samplerate
+        sr = decode.get('sample_rate', 22050)
+        sr = native_sr if sr == 'native' else sr
+        resample = {'res_type': decode['resample']} if decode.get('resample') else {}
+
+        def blocks() -> Iterator[numpy.ndarray]:
+            for block in soundfile.blocks(path, 
+                                          blocksize=stream.get('block_size', 1 << 18),
+                                          dtype='float32',
+                                          always_2d=True):
+                block = block[:, 0] if block.shape[1] == 1 else block.mean(axis=1)
+                if sr != native_sr:
+                    block = librosa.resample(block, orig_sr=native_sr, target_sr=sr, **resample)
+                yield block
+
+        return SpectraStream(blocks, sr, tuning=stream.get('tuning'))
+
+    def run(self, dataset: dict, path: str, audio: Tuple[numpy.ndarray, int] = None) -> None:
+        '''Callback to extract feature from an audio, loaded from path unless given.'''
+
+        if audio is None:
+            audio = self._cached_audio(path)
+        if isinstance(audio, CachedFeatures):
+            return audio.features
+
+        if audio is None and self.stream is not None:
+            chroma, contrast, mfccs = self.stream_audio(path).means()
+        else:
+            spectra = Spectra(*(audio if audio is not None else self.load_audio(path)))
+
+            # "chroma": "stft" derives the chroma from the shared STFT instead of a CQT
+            chroma = numpy.mean(spectra.chroma(self.config['feature'].get('chroma', 'cqt')))
+            contrast = numpy.mean(spectra.spectral_contrast())
+            mfccs = [numpy.mean(mfcc) for mfcc in spectra.mfcc()]
 
         features = {
-            'cqt': numpy.mean(cqt),
-            'spct_contrast': numpy.mean(spct_contrast),
+            'cqt': chroma,
+            'spct_contrast': contrast,
         }
 
-        for i, mfcc in enumerate(_parse_mfcc(data, sr=sr)):
+        for i, mfcc in enumerate(mfccs):
             features[f'mfc{i}'] = mfcc
 
+        if self.cache is not None:
+            # cached values are read back as floats, fresh ones are written alike
+            features = {name: float(value) for name, value in features.items()}
+            self.cache.store(path, {self.cache_digest: features})
         return features
+
+    def _cached_audio(self, path: str) -> CachedFeatures:
+        '''Features of a cached file, counting whether it is decoded.'''
+
+        if self.cache is None:
+            return None
+
+        features = self.cache.lookup(path).get(self.cache_digest)
+        self.cache.count(path, features is not None)
+        return CachedFeatures(features) if features is not None else None
             
     def dump(self, result_data: list, dataset: dict) -> Any:
         return [[dataset['class'], *list(counter.values())] 
@@ -1,4 +1,6 @@
 from typing import List, Tuple, Callable, Any
+import numpy
+import cv2
 import abc
 import json
 import logging
@@ -9,7 +11,7 @@ class BaseMethod(abc.ABC):
     def __init__(self, config: dict = {}):
         self.config = config
 
-    def init(self, datasets: list) -> None:
+    def init(self, datasets: list, resume: bool = False) -> None:
         pass
     
     @property
@@ -20,26 +22,86 @@ class BaseMethod(abc.ABC):
     def options(self) -> dict:
         return {}
 
+    @property
+    def outputs(self) -> List[str]:
+        '''Files every dataset appends its rows to, to be truncated when resuming.'''
+
+        return []
+
     @abc.abstractproperty
     def description(self) -> str:
         pass
 
+    def load_image(self, path: str) -> object:
+        '''Decode the image handed to run, methods may override it to decode less.'''
+
+        return cv2.imread(path)
+
+    def decode(self, content: bytes, path: str) -> object:
+        '''Decode a file read by the asyncio backend, as load_image would load it.'''
+
+        return cv2.imdecode(numpy.frombuffer(content, dtype=numpy.uint8), cv2.IMREAD_COLOR)
+
     @abc.abstractmethod
     def run(self, image: object, dataset: dict, path: str) -> None:
         pass
 
+    def run_batch(self, images: list, dataset: dict, paths: list) -> list:
+        '''Run several images at once, methods may override it to share work.'''
+
+        return [self.run(image, dataset, path) for image, path in zip(images, paths)]
+
     @abc.abstractmethod
     def dump(self, result_data: list, dataset: dict) -> List[Tuple[str, int]]:
         pass
 
+    def format_stat(self, key: Any) -> str:
+        '''Name of a stat key in the saved results, called only for the saved ones.'''
+
+        return key
+
     def save(self, path: str, result_data: list, dataset: dict) -> None:
         stats = self.dump(result_data, dataset)
+        self.write_stats(path, stats, dataset)
 
+    def write_stats(self, path: str, stats: List[Tuple[Any, int]], dataset: dict) -> None:
         max_results = dataset['pattern'].get('max_results')
         if max_results:
             stats = stats[:max_results]
 
-        content = {color: count for color, count in stats}
+        content = {self.format_stat(key): count for key, count in stats}
 
         with open(path, 'w') as writer:
             json.dump(content, writer, indent=4)
+
+    def write_to(self, sink: Any) -> None:
+        '''Send rows to a single writer of the outputs instead of appending to them.'''
+
+        pass
+
+    def report(self) -> None:
+        '''Log facts about the whole run, once every worker is done.'''
+
+        pass
+
+    def partial_path(self, path: str) -> str:
+        '''File save_partial leaves the results of a slice in.'''
+
+        return path
+
+    def save_partial(self, path: str, result_data: list, dataset: dict) -> None:
+        '''Save the results of a slice of a split dataset, to be reduced by summarize.'''
+
+        self.save(path, result_data, dataset)
+
+    def summarize(self, path: str, partial_paths: List[str], dataset: dict) -> None:
+        '''Save the results of a split dataset from the partials of its slices.'''
+
+        self.save(path, [self.load_stats(partial) for partial in partial_paths], dataset)
+
+    def load_stats(self, path: str) -> Any:
+        '''Recover the stats saved for a split, to be dumped along the other splits.'''
+
+        with open(path, 'r') as reader:
+            stats = json.load(reader)
+        return list(stats)
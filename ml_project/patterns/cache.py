@@ -0,0 +1,226 @@
+from multiprocessing import util as multiprocessing_util
+from typing import Any, Dict, NamedTuple, Tuple
+import numpy
+import hashlib
+import logging
+import json
+import glob
+import time
+import uuid
+import os
+
+
+_caches, _pcm_caches = {}, {}
+
+# content digests by path, size and modification time, hashed once per process
+_content_keys = {}
+
+
+def _reset_caches() -> None:
+    ''' Forked processes count their own hits '''
+
+    _caches.clear()
+    _pcm_caches.clear()
+    _content_keys.clear()
+
+
+os.register_at_fork(after_in_child=_reset_caches)
+
+
+def config_digest(value: Any) -> str:
+    ''' Digest of a JSON configuration entry, whatever the order of its keys '''
+
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def file_key(path: str, identity: str) -> str:
+    ''' Key of a file by its path, size and modification time ("stat") or its bytes ("content") '''
+
+    stat = os.stat(path)
+    stat_identity = f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+    if identity != 'content':
+        return hashlib.sha256(stat_identity.encode()).hexdigest()
+
+    # lookups and stores of both caches share the digest of an unchanged file
+    if stat_identity not in _content_keys:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as reader:
+            for block in iter(lambda: reader.read(1 << 20), b''):
+                digest.update(block)
+        _content_keys[stat_identity] = digest.hexdigest()
+    return _content_keys[stat_identity]
+
+
+def feature_cache(feature_config: dict) -> 'FeatureCache':
+    '''
+    Cache of the optional "cache" entry of the feature configuration, one for
+    each process:
+     - "path": directory holding the cached features.
+     - "identity": "stat" (default) recognizes a file by its path, size and
+       modification time, "content" by a hash of its bytes.
+    '''
+
+    cache_config = feature_config.get('cache')
+    if not cache_config:
+        return None
+
+    key = (cache_config['path'], cache_config.get('identity', 'stat'))
+    if key not in _caches:
+        _caches[key] = FeatureCache(*key)
+    return _caches[key]
+
+
+def pcm_cache(decode_config: dict) -> 'PcmCache':
+    '''
+    Cache of the optional "cache" entry of an audio decoding configuration,
+    taking the same "path" and "identity" entries as the feature cache.
+    '''
+
+    cache_config = decode_config.get('cache')
+    if not cache_config:
+        return None
+
+    key = (cache_config['path'], cache_config.get('identity', 'stat'))
+    if key not in _pcm_caches:
+        _pcm_caches[key] = PcmCache(*key)
+    return _pcm_caches[key]
+
+
+class CachedFeatures(NamedTuple):
+    '''Features of a file found in the cache, handed to run instead of its decoded content.'''
+
+    features: dict
+
+
+class FeatureCache:
+    '''
+    On-disk cache of the features of each file. Entries are keyed by the file
+    identity and map the digest of the configuration producing a feature to its
+    values, so editing the configuration of a feature only recomputes that one.
+
+    Every process counts the files it did not need to decode in a stats file of
+    the cache, summed up by report at the end of a run.
+    '''
+
+    flush_interval = 1.0
+
+    def __init__(self, path: str, identity: str = 'stat'):
+        if identity not in ('stat', 'content'):
+            raise ValueError(f'Unknown cache identity "{identity}".')
+
+        self.path, self.identity = path, identity
+        self.hits, self.misses, self.bytes_saved = 0, 0, 0
+        self._stats_path = os.path.join(path, 'stats', f'{uuid.uuid4().hex}.json')
+        self._flushed_at = 0.0
+
+        # worker processes exit without running atexit handlers
+        multiprocessing_util.Finalize(self, self.flush, exitpriority=0)
+
+    def lookup(self, path: str) -> Dict[str, dict]:
+        ''' Cached values of a file by configuration digest '''
+
+        try:
+            with open(self._entry_path(path), 'r') as reader:
+                return json.load(reader)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def store(self, path: str, features: Dict[str, dict]) -> None:
+        entry = self.lookup(path)
+        entry.update(features)
+
+        target = self._entry_path(path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        # concurrent readers see either entry, never a partial one
+        temporary = f'{target}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as writer:
+            json.dump(entry, writer)
+        os.replace(temporary, target)
+
+    def count(self, path: str, hit: bool) -> None:
+        ''' Count a file as decoded, or not thanks to the cache '''
+
+        if hit:
+            self.hits += 1
+            self.bytes_saved += os.path.getsize(path)
+        else:
+            self.misses += 1
+
+        if time.monotonic() - self._flushed_at > self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.hits and not self.misses:
+            return
+
+        os.makedirs(os.path.dirname(self._stats_path), exist_ok=True)
+        with open(self._stats_path, 'w') as writer:
+            json.dump(dict(hits=self.hits, misses=self.misses, bytes_saved=self.bytes_saved),
+                      writer)
+        self._flushed_at = time.monotonic()
+
+    def reset_stats(self) -> None:
+        ''' Drop the counts left by an interrupted run '''
+
+        for stats_path in glob.glob(os.path.join(self.path, 'stats', '*.json')):
+            os.unlink(stats_path)
+
+    def report(self) -> None:
+        ''' Log the counts of every process, once their workers exited '''
+
+        self.flush()
+
+        totals = dict(hits=0, misses=0, bytes_saved=0)
+        for stats_path in glob.glob(os.path.join(self.path, 'stats', '*.json')):
+            with open(stats_path, 'r') as reader:
+                for stat, value in json.load(reader).items():
+                    totals[stat] += value
+            os.unlink(stats_path)
+        self.hits, self.misses, self.bytes_saved = 0, 0, 0
+
+        files_count = (totals['hits'] + totals['misses']) or 1
+        logging.info('feature cache hits: %d/%d (%d%%) bytes not decoded: %d',
+                     totals['hits'],
+                     totals['hits'] + totals['misses'],
+                     totals['hits'] * 100 / files_count,
+                     totals['bytes_saved'])
+
+    def _entry_path(self, path: str) -> str:
+        key = file_key(path, self.identity)
+        return os.path.join(self.path, key[:2], f'{key}.json')
+
+
+class PcmCache:
+    '''
+    On-disk cache of decoded audio, as float32 samples along with their sample
+    rate. Entries are keyed by the file identity and the digest of the decoding
+    configuration, so files are decoded again only once either changes.
+    '''
+
+    def __init__(self, path: str, identity: str = 'stat'):
+        if identity not in ('stat', 'content'):
+            raise ValueError(f'Unknown cache identity "{identity}".')
+
+        self.path, self.identity = path, identity
+
+    def lookup(self, path: str, digest: str) -> Tuple[numpy.ndarray, int]:
+        try:
+            with numpy.load(self._entry_path(path, digest)) as entry:
+                return entry['data'], int(entry['sr'])
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+    def store(self, path: str, digest: str, data: numpy.ndarray, sr: int) -> None:
+        target = self._entry_path(path, digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        # concurrent readers see either entry, never a partial one
+        temporary = f'{target}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as writer:
+            numpy.savez(writer, data=data.astype(numpy.float32, copy=False), sr=sr)
+        os.replace(temporary, target)
+
+    def _entry_path(self, path: str, digest: str) -> str:
+        key = file_key(path, self.identity)
+        return os.path.join(self.path, key[:2], f'{key}-{digest[:16]}.npz')
@@ -1,20 +1,37 @@
 from .base import BaseMethod
-from .utils import map_image_pixels
-from parallel import wait_futures
+from .cache import FeatureCache, CachedFeatures, feature_cache, config_digest
+import numpy
+import cv2
 
-from collections import Counter
-from typing import Dict, Any
+from typing import Dict, List, Tuple, NamedTuple, Union, Any
 from concurrent.futures import ThreadPoolExecutor
 from abc import ABC, abstractmethod, abstractproperty
 import csv
+import copy
+import struct
+import io
+import os
+import json
+import math
 import logging
 
 
 class Formatter(ABC):
-    def __init__(self, path: str, columns: list, **kwargs):
+    # single writer the rows are sent to, appended straight to the file without one
+    sink = None
+
+    def __init__(self, path: str, columns: list, resume: bool = False, **kwargs):
+        names = [column['name'] for column in columns]
+        repeated = sorted({name for name in names if names.count(name) > 1})
+        if repeated:
+            raise ValueError(f'Repeated column names: {", ".join(repeated)}.')
+
         self.path = f'{path}.{self.extension}'
         self.columns = columns
-        self._add_header(**kwargs)
+
+        # resumed outputs already hold their header
+        if not (resume and os.path.exists(self.path)):
+            self._add_header(**kwargs)
 
     @abstractproperty
     def extension(self) -> str:
@@ -28,6 +45,20 @@ class Formatter(ABC):
     def append(self, content: str) -> None:
         pass
 
+    def write(self, content: Union[str, bytes]) -> None:
+        if self.sink is not None:
+            self.sink.write(self.path, content)
+            return
+
+        with open(self.path, 'ab' if isinstance(content, bytes) else 'a') as writer:
+            writer.write(content)
+        self.flushed()
+
+    def flushed(self) -> None:
+        '''Called once appended content reached the file, to update what describes it.'''
+
+        pass
+
 
 class ArffFormat(Formatter):
     @property
@@ -61,9 +92,7 @@ class ArffFormat(Formatter):
                 attributes = ','.join((str(value) for value in line))
                 yield attributes
 
-        with open(self.path, 'a') as writer:
-            for line in gen_arff():
-                writer.write(f'{line}\n')
+        self.write(''.join(f'{line}\n' for line in gen_arff()))
 
 
 class CsvFormat(Formatter):
@@ -78,9 +107,80 @@ class CsvFormat(Formatter):
             csv.DictWriter(writer, fieldnames=fields).writeheader()
 
     def append(self, rows: list) -> None:
-        with open(self.path, 'a') as writer:
-            csv_writter = csv.writer(writer)
-            csv_writter.writerows(rows)
+        buffer = io.StringIO()
+        csv_writter = csv.writer(buffer)
+        csv_writter.writerows(rows)
+        self.write(buffer.getvalue())
+
+
+class NpyFormat(Formatter):
+    '''
+    Rows as a structured numpy array, loadable with numpy.load (memory-mapped 
+    too) without any text parsing. The class is stored as the code of its
+    position in its list of "<output>.classes.json" and features as float64, or
+    float32 with {"binary": {"float32": true}} in the feature configuration.
+
+    The header leaves room for any row count, so appending only rewrites it
+    in place once the rows are flushed.
+    '''
+
+    magic = b'\x93NUMPY\x01\x00'
+
+    def __init__(self, path: str, columns: list, resume: bool = False, **kwargs):
+        float_type = numpy.float32 if (kwargs.get('binary') or {}).get('float32') else numpy.float64
+        fields = []
+        for column in columns:
+            if isinstance(column['type'], list):
+                fields.append((column['name'], numpy.min_scalar_type(len(column['type']))))
+            else:
+                fields.append((column['name'], float_type))
+        self.dtype = numpy.dtype(fields)
+        self.classes_path = f'{path}.classes.json'
+
+        super().__init__(path, columns, resume=resume, **kwargs)
+
+    @property
+    def extension(self) -> str:
+        return 'npy'
+
+    def _add_header(self, **kwargs) -> None:
+        with open(self.path, 'wb') as writer:
+            writer.write(self._header(0))
+
+        classes = {column['name']: column['type'] 
+                   for column in self.columns if isinstance(column['type'], list)}
+        with open(self.classes_path, 'w') as writer:
+            json.dump(classes, writer)
+
+    def append(self, rows: list) -> None:
+        records = numpy.empty(len(rows), dtype=self.dtype)
+        for index, row in enumerate(rows):
+            records[index] = tuple(
+                column['type'].index(value) if isinstance(column['type'], list) else value
+                for column, value in zip(self.columns, row))
+        self.write(records.tobytes())
+
+    def flushed(self) -> None:
+        header_size = len(self._header(0))
+        rows = (os.path.getsize(self.path) - header_size) // self.dtype.itemsize
+        with open(self.path, 'r+b') as writer:
+            writer.write(self._header(rows))
+
+    def _header(self, rows: int) -> bytes:
+        '''NPY 1.0 header, padded to the size it takes for the largest row count.'''
+
+        def description(rows):
+            return repr({
+                'descr': numpy.lib.format.dtype_to_descr(self.dtype),
+                'fortran_order': False,
+                'shape': (rows,),
+            })
+
+        # magic, header length and trailing newline, aligned on 64 bytes
+        fixed_size = len(self.magic) + 2 + 1
+        size = -(-(fixed_size + len(description(2 ** 63))) // 64) * 64 - fixed_size
+        header = description(rows).ljust(size) + '\n'
+        return self.magic + struct.pack('<H', len(header)) + header.encode('latin1')
 
 
 class NullFormatter(Formatter):
@@ -95,18 +195,45 @@ class NullFormatter(Formatter):
         pass
 
 
+class CroppedImage(NamedTuple):
+    '''Pixels cropped at (top, left) of an image sized (height, width).'''
+
+    pixels: numpy.ndarray
+    height: int
+    width: int
+    top: int
+    left: int
+
+
 class FeaturesExtractor(BaseMethod):
     available_formatters = {
         'arff': ArffFormat,
         'csv': CsvFormat,
+        'npy': NpyFormat,
         'null': NullFormatter
     }
 
+    # layout ranges index the pixel channels in the order they are loaded
+    channels = {
+        'red': 0,
+        'green': 1,
+        'blue': 2,
+    }
+
+    # opencv flags to decode at 1/n of the resolution
+    reduced_flags = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8,
+    }
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.path, self.feature_layouts, self.formatters = None, [], []
+        self._digests = None
 
-    def init(self, datasets: list) -> None:
+    def init(self, datasets: list, resume: bool = False) -> None:
         self.path = self.config['feature']['output']
 
         classes = []
@@ -114,9 +241,12 @@ class FeaturesExtractor(BaseMethod):
             self.feature_layouts.extend(dataset['feature']['layout'])
             classes.append(dataset['class'])
 
+        # layouts sharing a name are counted together as a single feature
         columns = [dict(name='class', type=classes)]
-        for feature in self.feature_layouts:
-            columns.append(dict(name=feature['name'], type='real'))
+        for name in dict.fromkeys(feature['name'] for feature in self.feature_layouts):
+            columns.append(dict(name=name, type='real'))
+            if self.sampling:
+                columns.append(dict(name=f'{name}_stderr', type='real'))
         
         out_format = self.config['feature'].get('format', 'all')
 
@@ -125,13 +255,49 @@ class FeaturesExtractor(BaseMethod):
         else:
             format_classes = [self.available_formatters[out_format]]
 
-        self.formatters = [klass(self.path, columns, **self.config['feature']) 
+        self.formatters = [klass(self.path, columns, resume=resume, **self.config['feature']) 
                            for klass in format_classes]
 
+        if self.cache is not None:
+            self.cache.reset_stats()
+
     @property
     def description(self) -> str:            
         return 'Extracts pre-defined image features.'
 
+    @property
+    def cache(self) -> FeatureCache:
+        '''Cache of the optional "cache" entry of the feature configuration.'''
+
+        return feature_cache(self.config['feature'])
+
+    def write_to(self, sink: Any) -> None:
+        for formatter in self.formatters:
+            formatter.sink = sink
+            sink.after_flush(formatter.path, formatter.flushed)
+
+    def report(self) -> None:
+        if self.cache is not None:
+            self.cache.report()
+
+    @property
+    def outputs(self) -> List[str]:
+        return [formatter.path for formatter in self.formatters if formatter.extension]
+
+    @property
+    def sampling(self) -> dict:
+        '''
+        Optional "sampling" entry of the feature configuration, trading accuracy 
+        for speed by counting only a sample of the pixels:
+         - {"mode": "stride", "factor": 4}: every 4th row and column.
+         - {"mode": "downscale", "factor": 2.5}: nearest pixel resize by 1/2.5.
+         - {"mode": "random", "size": 10000, "seed": 1}: 10000 random pixels.
+        When enabled, every feature is followed by a "<name>_stderr" column 
+        holding the estimated standard error of its percentage.
+        '''
+
+        return self.config['feature'].get('sampling') or {}
+
     @property
     def options(self) -> dict:
         return {
@@ -140,80 +306,389 @@ class FeaturesExtractor(BaseMethod):
             'service_impl': ThreadPoolExecutor,
         }
 
-    def run(self, image: str, dataset: dict, path: str) -> None:
+    def load_image(self, path: str) -> object:
+        '''
+        Decode an image following the optional "decode" entry of the feature 
+        configuration:
+         - "reduce": 2, 4 or 8 lets opencv decode at a reduced resolution.
+         - "crop": true drops the pixels outside every layout region.
+        '''
+
+        cached = self._cached_image(path)
+        if cached is not None:
+            return cached
+
+        decode = self.config['feature'].get('decode') or {}
+        image = cv2.imread(path, self.reduced_flags[decode.get('reduce', 1)])
+        return self._crop(image)
+
+    def decode(self, content: bytes, path: str) -> object:
+        '''Decode a file read by the asyncio backend, following the "decode" entry.'''
+
+        cached = self._cached_image(path)
+        if cached is not None:
+            return cached
+
+        decode = self.config['feature'].get('decode') or {}
+        image = cv2.imdecode(numpy.frombuffer(content, dtype=numpy.uint8), 
+                             self.reduced_flags[decode.get('reduce', 1)])
+        return self._crop(image)
+
+    def _crop(self, image: numpy.ndarray) -> object:
+        decode = self.config['feature'].get('decode') or {}
+        if image is None or not decode.get('crop'):
+            return image
+
+        height, width, _ = image.shape
+        top, bottom, left, right = self.layout_bounds(height, width)
+        return CroppedImage(image[top:bottom, left:right].copy(), height, width, top, left)
+
+    def run(self, image: object, dataset: dict, path: str) -> None:
         '''Callback to extract feature from image.'''
 
+        return self.run_batch([image], dataset, [path])[0]
+
+    def run_batch(self, images: list, dataset: dict, paths: list) -> list:
+        '''
+        Callback to extract features from several images, grouped by shape. 
+        Features found in the cache are not extracted again.
+        '''
+
+        digests = self.feature_digests()
+        results = [None] * len(images)
+        group_to_indexes, frames, cached = {}, {}, {}
+        for index, (image, path) in enumerate(zip(images, paths)):
+            if isinstance(image, CachedFeatures):
+                results[index] = image.features
+                continue
+
+            cached[index] = self._cached_features(path)
+            missing = tuple(name for name in digests if name not in cached[index])
+            frames[index] = self._frame(image)
+            pixels, geometry = frames[index]
+            group_to_indexes.setdefault((pixels.shape, geometry, missing), []).append(index)
+
+        for (_, geometry, missing), indexes in group_to_indexes.items():
+            extracted = [{} for _ in indexes]
+            if missing:
+                stack = numpy.stack([frames[index][0] for index in indexes])
+                extracted = self._restricted(missing)._extract(stack, *geometry)
+
+            for index, features in zip(indexes, extracted):
+                if self.cache is not None:
+                    features = self._cache_features(paths[index], features, cached[index])
+                results[index] = features
+        return results
+
+    def feature_digests(self) -> Dict[str, str]:
+        '''Digest of the configuration producing each feature, keying its cached values.'''
+
+        if self._digests is None:
+            decode = self.config['feature'].get('decode') or {}
+            name_to_layouts = {}
+            for feature in self.feature_layouts:
+                name_to_layouts.setdefault(feature['name'], []).append(feature)
+
+            self._digests = {name: config_digest(dict(layouts=layouts,
+                                                      sampling=self.sampling,
+                                                      reduce=decode.get('reduce', 1)))
+                             for name, layouts in name_to_layouts.items()}
+        return self._digests
+
+    def _cached_image(self, path: str) -> CachedFeatures:
+        '''Features of a file when all of them are cached, counting whether it is decoded.'''
+
+        if self.cache is None:
+            return None
+
+        cached = self._cached_features(path)
+        hit = len(cached) == len(self.feature_digests())
+        self.cache.count(path, hit)
+        return CachedFeatures(self._cache_features(path, {}, cached)) if hit else None
+
+    def _cached_features(self, path: str) -> Dict[str, dict]:
+        '''Cached columns of a file by feature name.'''
+
+        if self.cache is None or path is None:
+            return {}
+
+        entry = self.cache.lookup(path)
+        return {name: entry[digest] for name, digest in self.feature_digests().items() 
+                if digest in entry}
+
+    def _cache_features(self, path: str, features: dict, cached: Dict[str, dict]) -> dict:
+        '''Store the extracted features of a file, merged with its cached ones in column order.'''
+
+        digests = self.feature_digests()
+        computed = {}
+        for name in digests:
+            if name not in cached:
+                computed[name] = {column: features[column] 
+                                  for column in (name, f'{name}_stderr') if column in features}
+
+        if computed and path is not None:
+            self.cache.store(path, {digests[name]: columns for name, columns in computed.items()})
+
+        merged = {}
+        for name in digests:
+            merged.update(cached.get(name) or computed[name])
+        return merged
+
+    def _restricted(self, names: tuple) -> 'FeaturesExtractor':
+        '''The same extractor, limited to the features of the given names.'''
+
+        if len(names) == len(self.feature_digests()):
+            return self
+
+        extractor = copy.copy(self)
+        extractor.feature_layouts = [feature for feature in self.feature_layouts 
+                                     if feature['name'] in names]
+        return extractor
+
+    def _frame(self, image: object) -> Tuple[numpy.ndarray, Tuple[int, int, int, int]]:
+        '''Split an image into its pixels and the (height, width, top, left) of its frame.'''
+
+        if isinstance(image, CroppedImage):
+            return image.pixels, (image.height, image.width, image.top, image.left)
+
         height, width, _ = image.shape
+        return image, (height, width, 0, 0)
+
+    def _extract(self, 
+                 images: numpy.ndarray, 
+                 height: int, 
+                 width: int, 
+                 top: int = 0, 
+                 left: int = 0) -> list:
+        '''
+        Count the layout features of a stack of same sized images, which may be 
+        cropped at (top, left) of a frame sized (height, width).
+        '''
+
+        frame = (height, width, top, left)
+        if self.sampling.get('mode') == 'random':
+            features_counter, samples_count = self._count_random(images, *frame)
+        else:
+            features_counter, samples_count = self._count_grid(images, *frame)
+
+        results = []
+        for image_index in range(len(images)):
+            features = {}
+            for feature in self.feature_layouts:
+                count = int(features_counter[feature['name']][image_index])
+                features[feature['name']] = (count * 100) / samples_count
+                if self.sampling:
+                    features[f'{feature["name"]}_stderr'] = self.standard_error(count, 
+                                                                                samples_count, 
+                                                                                width * height)
+            results.append(features)
+        return results
+
+    def _count_grid(self, 
+                    images: numpy.ndarray, 
+                    height: int, 
+                    width: int, 
+                    top: int, 
+                    left: int) -> Tuple[dict, int]:
+        '''Count features over the full image, or over a grid of sampled rows and columns.'''
+
+        _, crop_height, crop_width, _ = images.shape
+        rows, cols = self.sample_grid(height, width)
+
+        # positions of the sampled grid which fall inside the crop
+        row_start, row_stop = numpy.searchsorted(rows, (top, top + crop_height))
+        col_start, col_stop = numpy.searchsorted(cols, (left, left + crop_width))
+        crop_rows, crop_cols = rows[row_start:row_stop] - top, cols[col_start:col_stop] - left
+
+        if self.sampling.get('mode') == 'stride':
+            # regular steps can be read as a view, without copying pixels
+            factor = self.sampling['factor']
+            images = images[:, (-top) % factor::factor, (-left) % factor::factor]
+        elif len(crop_rows) != crop_height or len(crop_cols) != crop_width:
+            images = images[:, crop_rows[:, numpy.newaxis], crop_cols]
+
+        features_counter = {}
+        for ranges, features in self.color_groups():
+            # a single region is cheaper to count straight from its window
+            table = None
+            if len(features) > 1:
+                table = self.integral_image(self.color_mask(images, ranges))
+
+            for feature in features:
+                region = self.region_bounds(height, width, feature.get('regions', {}))
+
+                # translate the region into positions of the sampled grid
+                region_top, region_bottom = numpy.clip(
+                    numpy.searchsorted(rows, region[:2]) - row_start, 0, len(crop_rows))
+                region_left, region_right = numpy.clip(
+                    numpy.searchsorted(cols, region[2:]) - col_start, 0, len(crop_cols))
+
+                if table is None:
+                    window = images[:, region_top:region_bottom, region_left:region_right]
+                    matches = numpy.count_nonzero(self.color_mask(window, ranges), axis=(1, 2))
+                else:
+                    matches = table[:, region_bottom, region_right] - \
+                        table[:, region_top, region_right] - \
+                        table[:, region_bottom, region_left] + \
+                        table[:, region_top, region_left]
+
+                name = feature['name']
+                features_counter[name] = features_counter.get(name, 0) + matches
+        return features_counter, len(rows) * len(cols)
+
+    def _count_random(self, 
+                      images: numpy.ndarray, 
+                      height: int, 
+                      width: int, 
+                      top: int, 
+                      left: int) -> Tuple[dict, int]:
+        '''Count features over the same random pixels of every image.'''
+
+        count, crop_height, crop_width, channels = images.shape
+        size = min(self.sampling['size'], height * width)
+
+        generator = numpy.random.default_rng(self.sampling.get('seed'))
+        indexes = generator.choice(height * width, size=size, replace=False)
+        rows, cols = numpy.divmod(indexes, width)
+
+        # samples outside the crop are outside every region as well
+        in_crop = (rows >= top) & (rows < top + crop_height) & \
+            (cols >= left) & (cols < left + crop_width)
+        rows, cols = rows[in_crop], cols[in_crop]
+        crop_indexes = (rows - top) * crop_width + (cols - left)
+        # an empty crop keeps its channels, no sample falling in it
+        pixels = images.reshape(count, crop_height * crop_width, channels)[:, crop_indexes]
+
+        features_counter = {}
+        for ranges, features in self.color_groups():
+            color_mask = self.color_mask(pixels, ranges)
+
+            for feature in features:
+                region_top, region_bottom, region_left, region_right = self.region_bounds(
+                    height, width, feature.get('regions', {}))
+                in_region = (rows >= region_top) & (rows < region_bottom) & \
+                    (cols >= region_left) & (cols < region_right)
+                name = feature['name']
+                features_counter[name] = features_counter.get(name, 0) + \
+                    numpy.count_nonzero(color_mask & in_region, axis=1)
+        return features_counter, size
+
+    def color_groups(self) -> List[Tuple[dict, list]]:
+        '''Layout features grouped by their color ranges, so each range is matched once.'''
+
+        groups = {}
+        for feature in self.feature_layouts:
+            key = json.dumps(feature['ranges'], sort_keys=True)
+            groups.setdefault(key, (feature['ranges'], []))[1].append(feature)
+        return list(groups.values())
 
-        services = map_image_pixels(image)
-        _, results = wait_futures(self._extract, 
-                                        services, 
-                                        height, 
-                                        width,
-                                        show_status=False,
-                                        mask_result=True,
-                                        impl=ThreadPoolExecutor,
-                                        **dataset['feature'].get('executor_kwargs', {}))
+    def integral_image(self, mask: numpy.ndarray) -> numpy.ndarray:
+        '''
+        Summed-area table of a stack of masks, padded with a leading row and 
+        column of zeros so table[:, y, x] counts the matches above and left of (y, x).
+        '''
 
-        features_counter = Counter()
-        for counter in results:
-            features_counter.update(counter)
+        count, height, width = mask.shape
+        table = numpy.zeros((count, height + 1, width + 1), dtype=numpy.int32)
+        numpy.cumsum(mask, axis=1, dtype=numpy.int32, out=table[:, 1:, 1:])
+        numpy.cumsum(table[:, 1:, 1:], axis=2, out=table[:, 1:, 1:])
+        return table
 
-        pixels_count = width * height
+    def sample_grid(self, height: int, width: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        '''Rows and columns read by the "stride" and "downscale" sampling modes.'''
 
-        features = {}
-        for feature in self.feature_layouts:
-            count = 0
-            if feature['name'] in features_counter:
-                count = features_counter[feature['name']]
-            features[feature['name']] = (count * 100) / pixels_count
-        return features
+        mode = self.sampling.get('mode')
 
-    def _extract(self, img_info: tuple, height: int, width: int) -> Counter:
-        x, y, pixel = img_info
-        region_args = (width, height, x, y)
-        features_counter = Counter()
+        if mode is None:
+            return numpy.arange(height), numpy.arange(width)
 
-        for feature in self.feature_layouts:
-            if self.is_in_region(*region_args, feature.get('regions', {})) and \
-                    self.is_in_color(*pixel, feature['ranges']):
-                features_counter.update({feature['name']: 1})
-        return features_counter
-
-    def is_in_color(self, red, green, blue, ranges: Dict[str, Dict[str, int]]):
-        is_in = lambda needle, initial, end: needle >= initial and needle <= end
-        available_ranges = {
-            'red': lambda *args: is_in(red, *args),
-            'blue': lambda *args: is_in(blue, *args),
-            'green': lambda *args: is_in(green, *args),
-        }
+        factor = self.sampling['factor']
+        if mode == 'stride':
+            return numpy.arange(0, height, factor), numpy.arange(0, width, factor)
+
+        if mode == 'downscale':
+            # nearest pixel of the center of each output pixel, as a resize would pick
+            def nearest(size):
+                output_size = max(1, int(round(size / factor)))
+                centers = (numpy.arange(output_size) + 0.5) * (size / output_size)
+                return numpy.minimum(centers.astype(int), size - 1)
+            return nearest(height), nearest(width)
+
+        raise ValueError(f'Unknown sampling mode "{mode}".')
+
+    def standard_error(self, count: int, samples_count: int, pixels_count: int) -> float:
+        '''
+        Standard error of a feature percentage estimated from a pixel sample,
+        treated as a simple random sample without replacement.
+        '''
+
+        if samples_count >= pixels_count:
+            return 0.0
+
+        proportion = count / samples_count
+        finite_population = (pixels_count - samples_count) / (pixels_count - 1)
+        variance = proportion * (1 - proportion) / samples_count * finite_population
+        return math.sqrt(max(variance, 0)) * 100
+
+    def color_mask(self, image: numpy.ndarray, ranges: Dict[str, Dict[str, int]]) -> numpy.ndarray:
+        '''Boolean mask of the pixels inside every channel range (margins included).'''
+
+        mask = numpy.ones(image.shape[:-1], dtype=bool)
 
         for range_name, ranges in ranges.items():
             margin = ranges.get('margin', 0)
             from_, to = ranges['from'] - margin, ranges.get('to', ranges['from']) + margin
-            if not available_ranges[range_name](from_, to):
-                return False
-        return True
-
-    def is_in_region(self, 
-                     width: float, 
-                     height: float, 
-                     x: int, 
-                     y: int, 
-                     regions: Dict[str, int]) -> bool:
-        available_regions = {
-            # top level regions
-            'bottom': lambda size: x > height * size,
-            'top': lambda size: x < height * size,
-            'left': lambda size: y < width * size,
-            'right': lambda size: y > width * size,
-        }
+
+            # pixel values are 8 bits, clamp bounds to avoid overflowing comparisons
+            from_, to = max(from_, 0), min(to, 255)
+            if from_ > to:
+                return numpy.zeros(image.shape[:-1], dtype=bool)
+
+            channel = image[..., self.channels[range_name]]
+            mask &= (channel >= from_) & (channel <= to)
+        return mask
+
+    def layout_bounds(self, height: int, width: int) -> Tuple[int, int, int, int]:
+        '''Smallest (top, bottom, left, right) slice holding the regions of every feature.'''
+
+        bounds = [self.region_bounds(height, width, feature.get('regions', {}))
+                  for feature in self.feature_layouts]
+        bounds = [(top, bottom, left, right) for top, bottom, left, right in bounds
+                  if top < bottom and left < right]
+
+        if not bounds:
+            return 0, 0, 0, 0
+
+        tops, bottoms, lefts, rights = zip(*bounds)
+        return min(tops), max(bottoms), min(lefts), max(rights)
+
+    def region_bounds(self, 
+                      height: int, 
+                      width: int, 
+                      regions: Dict[str, int]) -> Tuple[int, int, int, int]:
+        '''
+        Translate the layout regions into a (top, bottom, left, right) slice 
+        of the image. Boundaries are exclusive, so a row "x" is in the "top" 
+        region when x < height * size, and in "bottom" when x > height * size.
+        '''
+
+        top, bottom, left, right = 0, height, 0, width
 
         for region, size in regions.items():
             formatted_size = size / 100
-            if not available_regions[region](formatted_size):
-                return False
-        return True
+            if region == 'top':
+                bottom = min(bottom, math.ceil(height * formatted_size))
+            elif region == 'bottom':
+                top = max(top, math.floor(height * formatted_size) + 1)
+            elif region == 'left':
+                right = min(right, math.ceil(width * formatted_size))
+            elif region == 'right':
+                left = max(left, math.floor(width * formatted_size) + 1)
+            else:
+                raise KeyError(region)
+
+        # empty regions result in empty slices
+        return top, max(top, bottom), left, max(left, right)
             
     def dump(self, result_data: list, dataset: dict) -> Any:
         return [[dataset['class'], *list(counter.values())] 
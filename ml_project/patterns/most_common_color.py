@@ -1,9 +1,10 @@
 from .base import BaseMethod
-from .utils import image2hex
+from .utils import image2packed, histogram2stats, packed2hex, PACKED_COLORS
+from .sketch import SpaceSaving, sketch_capacity, merge_sketches
+from .partials import partial_path, save_partial, merge_partials, top_entries
+import numpy
 
-from collections import Counter
-from typing import Tuple, Any
-from multiprocessing import Manager
+from typing import List, Tuple, Any
 
 
 class MostCommonColor(BaseMethod):
@@ -11,18 +12,71 @@ class MostCommonColor(BaseMethod):
     def description(self):
         return 'Collects the top colors in all images.'
 
-    def run(self, image: str, dataset: dict, path: str) -> None:
-        '''Callback to count colors.'''
+    @property
+    def options(self) -> dict:
+        return {
+            'shared_arrays': True,
+        }
 
-        counter = Counter()
+    def run(self, image: str, dataset: dict, path: str) -> numpy.ndarray:
+        '''Callback to count colors, as a (colors, counts) array of packed colors.'''
 
-        for pixel_hex in image2hex(image):
-            # increment this hex color
-            counter.update({pixel_hex: 1})
-        return counter
+        colors, counts = numpy.unique(image2packed(image), return_counts=True)
+        return numpy.stack((colors.astype(numpy.int64), counts))
 
     def dump(self, result_data: list, dataset: dict) -> Any:
-        final_counter = Counter()
-        for counter in result_data:
-            final_counter.update(counter)
-        return final_counter.most_common()
\ No newline at end of file
+        if sketch_capacity(dataset):
+            return self.sketch(result_data, dataset).stats()
+
+        return histogram2stats(self.histogram(result_data), 
+                               limit=dataset.get('pattern', {}).get('max_results'))
+
+    def histogram(self, result_data: list) -> numpy.ndarray:
+        histogram = numpy.zeros(PACKED_COLORS, dtype=numpy.int64)
+        for result in result_data:
+            if result is None:
+                continue
+
+            colors, counts = result
+            histogram[colors] += counts
+        return histogram
+
+    def format_stat(self, color: int) -> str:
+        return packed2hex(color)
+
+    def sketch(self, result_data: list, dataset: dict) -> SpaceSaving:
+        '''Bounded summary of the most common colors, for the "sketch" pattern mode.'''
+
+        capacity = sketch_capacity(dataset)
+        sketch = SpaceSaving(capacity)
+        for result in result_data:
+            if result is None:
+                continue
+
+            if not isinstance(result, SpaceSaving):
+                result = SpaceSaving.from_counts(capacity, *result)
+            sketch = sketch.merge(result)
+        return sketch
+
+    def partial_path(self, path: str) -> str:
+        return partial_path(path)
+
+    def save_partial(self, path: str, result_data: list, dataset: dict) -> None:
+        '''Save the sketch or the full color counts of a slice, top results are left for the end.'''
+
+        if sketch_capacity(dataset):
+            self.sketch(result_data, dataset).save(partial_path(path))
+            return
+
+        histogram = self.histogram(result_data)
+        colors = numpy.flatnonzero(histogram)
+        save_partial(partial_path(path), colors, histogram[colors])
+
+    def summarize(self, path: str, partial_paths: List[str], dataset: dict) -> None:
+        capacity = sketch_capacity(dataset)
+        if capacity:
+            stats = merge_sketches(capacity, partial_paths).stats()
+        else:
+            stats = top_entries(merge_partials(partial_paths), 
+                                limit=dataset['pattern'].get('max_results'))
+        self.write_stats(path, stats, dataset)
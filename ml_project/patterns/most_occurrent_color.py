@@ -1,11 +1,10 @@
 from .base import BaseMethod
-from .utils import image2hex
-from parallel import wait_futures, display_status
+from .utils import image2packed, histogram2stats, packed2hex, PACKED_COLORS
+from .sketch import SpaceSaving, sketch_capacity, merge_sketches
+from .partials import partial_path, save_partial, merge_partials, top_entries
+import numpy
 
-from collections import Counter
-from typing import List, Tuple, Set
-from concurrent import futures
-from multiprocessing import Manager
+from typing import List, Tuple
 import logging
 
 
@@ -13,38 +12,84 @@ class MostOccurentColor(BaseMethod):
     @property
     def description(self) -> str:
         return 'Collects the colors which has the most frequency.'
+
+    @property
+    def options(self) -> dict:
+        return {
+            'shared_arrays': True,
+        }
         
-    def run(self, image: object, dataset: dict, path: str) -> Set:
-        hex_map = set()
-        for pixel in image2hex(image):
-            hex_map.add(pixel)
-        return hex_map
-    
-    def _count_pixel_occurrences(self, input_data: tuple, results: list) -> Counter:
-        current_index, pixels = input_data
-        counter = Counter()
-
-        for pixel in pixels:
-            for other_index, other_pixels in enumerate(results):
-                if current_index != other_index and pixel in other_pixels:
-                    counter.update({pixel: 1})
-
-        return counter
-
-    def dump(self, hex_map, dataset: dict) -> List[Tuple[str, int]]:
-        final_result = Counter()
-        pixel_info = [(index, pixels) for index, pixels in enumerate(hex_map)]
-        logging.info('starting jobs to count pixel occurrences')
-        faileds, counters = wait_futures(self._count_pixel_occurrences, 
-                                         pixel_info, 
-                                         hex_map,
-                                         show_status=False,
-                                         mask_result=True,
-                                         **dataset['pattern'].get('executor_kwargs', {}))
+    def run(self, image: object, dataset: dict, path: str) -> numpy.ndarray:
+        '''Callback to collect the unique packed colors of an image.'''
+
+        return numpy.unique(image2packed(image)).astype(numpy.int64)
+
+    def dump(self, hex_map, dataset: dict) -> List[Tuple[int, int]]:
+        '''
+        Count in how many other images each color appears, from the number of 
+        images holding it (its document frequency).
+        '''
+
+        if sketch_capacity(dataset):
+            return self._occurrences(self.sketch(hex_map, dataset))
+
+        # occurrences in the other images, colors of a single image are left out
+        return histogram2stats(numpy.maximum(self.frequencies(hex_map) - 1, 0), 
+                                limit=dataset.get('pattern', {}).get('max_results'))
+
+    def frequencies(self, hex_map: list) -> numpy.ndarray:
+        '''Number of images holding each packed color.'''
+
+        logging.info('starting to count pixel occurrences')
+        frequencies = numpy.zeros(PACKED_COLORS, dtype=numpy.int64)
+        for pixels in hex_map:
+            if pixels is None:
+                continue
+
+            frequencies[pixels] += 1
         logging.info('pixel occurrence count just finished')
-        for counter in counters:
-            for key, count in counter.items():
-                if key not in final_result.keys():
-                    final_result.update({key: count})
+        return frequencies
+
+    def format_stat(self, color: int) -> str:
+        return packed2hex(color)
+
+    def sketch(self, hex_map: list, dataset: dict) -> SpaceSaving:
+        '''Bounded summary of the colors document frequency, for the "sketch" pattern mode.'''
+
+        capacity = sketch_capacity(dataset)
+        sketch = SpaceSaving(capacity)
+        for pixels in hex_map:
+            if pixels is None:
+                continue
+
+            if not isinstance(pixels, SpaceSaving):
+                pixels = SpaceSaving.from_counts(capacity, pixels, 1)
+            sketch = sketch.merge(pixels)
+        return sketch
+
+    def _occurrences(self, sketch: SpaceSaving) -> List[Tuple[int, int]]:
+        return [(color, count - 1) for color, count in sketch.stats() if count > 1]
+
+    def partial_path(self, path: str) -> str:
+        return partial_path(path)
+
+    def save_partial(self, path: str, hex_map: list, dataset: dict) -> None:
+        '''Save the sketch or the full frequencies of a slice, occurrences are left for the end.'''
+
+        if sketch_capacity(dataset):
+            self.sketch(hex_map, dataset).save(partial_path(path))
+            return
+
+        frequencies = self.frequencies(hex_map)
+        colors = numpy.flatnonzero(frequencies)
+        save_partial(partial_path(path), colors, frequencies[colors])
 
-        return final_result.most_common()
\ No newline at end of file
+    def summarize(self, path: str, partial_paths: List[str], dataset: dict) -> None:
+        capacity = sketch_capacity(dataset)
+        if capacity:
+            stats = self._occurrences(merge_sketches(capacity, partial_paths))
+        else:
+            frequencies = merge_partials(partial_paths)
+            stats = top_entries(((colors, counts - 1) for colors, counts in frequencies), 
+                                limit=dataset['pattern'].get('max_results'))
+        self.write_stats(path, stats, dataset)
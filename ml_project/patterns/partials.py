@@ -0,0 +1,79 @@
+from typing import Iterator, List, Tuple
+import numpy
+
+
+# (key, count) entries of a slice, sorted by key
+PARTIAL_DTYPE = numpy.dtype([('key', '<i8'), ('count', '<i8')])
+
+
+def partial_path(path: str) -> str:
+    return f'{path}.partial'
+
+
+def save_partial(path: str, keys: numpy.ndarray, counts: numpy.ndarray) -> None:
+    ''' Save the counts of unique sorted keys as a numpy array file '''
+
+    entries = numpy.empty(len(keys), dtype=PARTIAL_DTYPE)
+    entries['key'], entries['count'] = keys, counts
+
+    with open(path, 'wb') as writer:
+        numpy.save(writer, entries)
+
+
+def merge_partials(paths: List[str],
+                   block_size: int = 1 << 16) -> Iterator[Tuple[numpy.ndarray, numpy.ndarray]]:
+    '''
+    K-way merge of saved partials, yielding blocks of unique increasing keys
+    along with their counts summed over every partial. Partials are mapped in
+    memory and read a block at a time, whatever their number and size.
+    '''
+
+    runs = [numpy.load(path, mmap_mode='r') for path in paths]
+    runs = [run for run in runs if len(run)]
+    positions = [0] * len(runs)
+
+    while runs:
+        blocks = [run[position:position + block_size] for run, position in zip(runs, positions)]
+
+        # no run holds keys below the last key of its block, up to the smallest
+        # of those every count is known
+        bound = min(block['key'][-1] for block in blocks)
+
+        keys, counts = [], []
+        for index, block in enumerate(blocks):
+            taken = numpy.searchsorted(block['key'], bound, side='right')
+            keys.append(block['key'][:taken])
+            counts.append(block['count'][:taken])
+            positions[index] += taken
+
+        keys, counts = numpy.concatenate(keys), numpy.concatenate(counts)
+        order = numpy.argsort(keys, kind='stable')
+        keys, counts = keys[order], counts[order]
+        starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+        yield keys[starts], numpy.add.reduceat(counts, starts)
+
+        remaining = [index for index, run in enumerate(runs) if positions[index] < len(run)]
+        runs = [runs[index] for index in remaining]
+        positions = [positions[index] for index in remaining]
+
+
+def top_entries(blocks: Iterator[Tuple[numpy.ndarray, numpy.ndarray]],
+                limit: int = None) -> List[Tuple[int, int]]:
+    '''
+    Positive (key, count) entries of streamed blocks, most common first and
+    ties by key, holding no more than about twice "limit" entries meanwhile.
+    '''
+
+    kept_keys = numpy.zeros(0, dtype=numpy.int64)
+    kept_counts = numpy.zeros(0, dtype=numpy.int64)
+    for keys, counts in blocks:
+        positive = counts > 0
+        kept_keys = numpy.concatenate((kept_keys, keys[positive]))
+        kept_counts = numpy.concatenate((kept_counts, counts[positive]))
+
+        if limit and len(kept_keys) > 2 * limit:
+            order = numpy.lexsort((kept_keys, -kept_counts))[:limit]
+            kept_keys, kept_counts = kept_keys[order], kept_counts[order]
+
+    order = numpy.lexsort((kept_keys, -kept_counts))[:limit]
+    return list(zip(kept_keys[order].tolist(), kept_counts[order].tolist()))
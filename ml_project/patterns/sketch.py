@@ -0,0 +1,115 @@
+from typing import List, Tuple
+import numpy
+import math
+
+
+def sketch_capacity(dataset: dict) -> int:
+    '''
+    Number of counters of the optional "sketch" entry of a dataset pattern,
+    enough to keep "max_results" and to bound count errors by "error" times
+    the total count.
+    '''
+
+    pattern = dataset.get('pattern', {})
+    sketch = pattern.get('sketch')
+    if not sketch:
+        return 0
+
+    return max(pattern.get('max_results') or 0, math.ceil(1 / sketch['error']))
+
+
+class SpaceSaving:
+    '''
+    Mergeable Space-Saving summary holding the heaviest "capacity" keys.
+
+    Counts may be overestimated by at most their "errors", and any key left
+    out counts at most "floor". Merging summaries keeps those guarantees, so
+    workers and splits can be reduced in any order.
+    '''
+
+    def __init__(self,
+                 capacity: int,
+                 keys: numpy.ndarray = None,
+                 counts: numpy.ndarray = None,
+                 errors: numpy.ndarray = None,
+                 floor: int = 0):
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        self.capacity = capacity
+        self.keys = empty if keys is None else numpy.asarray(keys, dtype=numpy.int64)
+        self.counts = empty if counts is None else numpy.asarray(counts, dtype=numpy.int64)
+        self.errors = numpy.zeros_like(self.counts) if errors is None else \
+            numpy.asarray(errors, dtype=numpy.int64)
+        self.floor = floor
+
+    @classmethod
+    def from_counts(cls, capacity: int, keys: numpy.ndarray, counts) -> 'SpaceSaving':
+        ''' Exact summary of unique sorted keys, to be merged into a bounded one '''
+
+        counts = numpy.broadcast_to(numpy.asarray(counts, dtype=numpy.int64),
+                                    numpy.shape(keys))
+        return cls(capacity, keys, counts)
+
+    def merge(self, other: 'SpaceSaving') -> 'SpaceSaving':
+        keys = numpy.union1d(self.keys, other.keys)
+        counts = self._lookup(self.counts, keys, self.floor) + \
+            other._lookup(other.counts, keys, other.floor)
+        errors = self._lookup(self.errors, keys, self.floor) + \
+            other._lookup(other.errors, keys, other.floor)
+
+        merged = SpaceSaving(self.capacity, keys, counts, errors, self.floor + other.floor)
+        return merged._prune()
+
+    def stats(self, limit: int = None) -> List[Tuple[int, int]]:
+        ''' Estimated (key, count) entries, heaviest first '''
+
+        order = numpy.lexsort((self.keys, -self.counts))[:limit]
+        return list(zip(self.keys[order].tolist(), self.counts[order].tolist()))
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as writer:
+            numpy.savez(writer,
+                        capacity=self.capacity,
+                        floor=self.floor,
+                        keys=self.keys,
+                        counts=self.counts,
+                        errors=self.errors)
+
+    @classmethod
+    def load(cls, path: str) -> 'SpaceSaving':
+        with numpy.load(path) as content:
+            return cls(int(content['capacity']),
+                       content['keys'],
+                       content['counts'],
+                       content['errors'],
+                       int(content['floor']))
+
+    def _lookup(self, values: numpy.ndarray, keys: numpy.ndarray, default: int) -> numpy.ndarray:
+        if not len(self.keys):
+            return numpy.full(len(keys), default, dtype=numpy.int64)
+
+        positions = numpy.minimum(numpy.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return numpy.where(self.keys[positions] == keys, values[positions], default)
+
+    def _prune(self) -> 'SpaceSaving':
+        if len(self.keys) <= self.capacity:
+            return self
+
+        order = numpy.lexsort((self.keys, -self.counts))
+        kept, dropped = numpy.sort(order[:self.capacity]), order[self.capacity:]
+
+        # dropped keys counted at most their estimate
+        floor = max(self.floor, int(self.counts[dropped].max()))
+        return SpaceSaving(self.capacity,
+                           self.keys[kept],
+                           self.counts[kept],
+                           self.errors[kept],
+                           floor)
+
+
+def merge_sketches(capacity: int, paths: List[str]) -> SpaceSaving:
+    ''' Reduce saved sketches one at a time '''
+
+    sketch = SpaceSaving(capacity)
+    for path in paths:
+        sketch = sketch.merge(SpaceSaving.load(path))
+    return sketch
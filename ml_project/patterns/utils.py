@@ -1,12 +1,43 @@
-from typing import Union, Any, List, Callable, Generator
+from typing import Union, Any, List, Tuple, Callable, Generator
+import numpy
 import os
 
+# number of distinct colors packed as 24 bits integers
+PACKED_COLORS = 1 << 24
+
 
 def rgb2hex(red, green, blue):
     # see https://www.codespeedy.com/convert-rgb-to-hex-color-code-in-python/
     return '0x%02x%02x%02x' % (red, green, blue)
 
 
+def packed2hex(color: int) -> str:
+    # same formatting as rgb2hex for a color packed by image2packed
+    return '0x%06x' % color
+
+
+def image2packed(image) -> numpy.ndarray:
+    ''' Pack every pixel of an image in a 24 bits integer, first channel first '''
+
+    image = image.reshape(-1, 3).astype(numpy.uint32)
+    return (image[:, 0] << 16) | (image[:, 1] << 8) | image[:, 2]
+
+
+def histogram2stats(histogram: numpy.ndarray, limit: int = None) -> List[Tuple[int, int]]:
+    ''' Non zero (color, count) entries of a packed histogram, most common first '''
+
+    colors = numpy.flatnonzero(histogram)
+    counts = histogram[colors]
+
+    if limit and limit < len(colors):
+        # keep every color tied with the last one, so ties are broken as a full sort would
+        threshold = numpy.partition(counts, len(counts) - limit)[len(counts) - limit]
+        colors, counts = colors[counts >= threshold], counts[counts >= threshold]
+
+    order = numpy.lexsort((colors, -counts))[:limit]
+    return list(zip(colors[order].tolist(), counts[order].tolist()))
+
+
 def image2hex(image) -> List[str]:
     return map_image_pixels(image, function=lambda _,__,px: rgb2hex(*px))
 
@@ -0,0 +1,141 @@
+#-*- coding: utf-8 -*-
+
+'''
+
+This module exposes the single writer of the outputs every dataset appends
+its rows to, so services of any process never open them concurrently.
+
+'''
+
+from checkpoint import Journal
+
+from contextlib import contextmanager
+from typing import IO, Callable, Dict, List, Tuple, Union
+import multiprocessing
+import threading
+import logging
+import queue
+
+
+class OutputSink:
+    '''
+    Services send the content of their rows through a queue and a thread of the
+    main process writes it, keeping the outputs open for the whole run.
+
+    Rows sent while recording a slice are held until the slice is recorded,
+    then written, flushed and journaled on their own, so the sizes journaled
+    for a slice never count rows of slices not journaled yet.
+
+    Only the queue is sent along with the sink to services.
+    '''
+
+    buffer_size = 1 << 20
+
+    def __init__(self, outputs: List[str], journal: Journal = None):
+        self.outputs, self.journal = outputs, journal
+        self._callbacks, self._error = {}, None
+        self._recording = threading.local()
+        self._manager = multiprocessing.Manager()
+        self.queue = self._manager.Queue()
+        self._thread = threading.Thread(target=self._run, name='output-sink', daemon=True)
+        self._thread.start()
+
+    def __getstate__(self) -> dict:
+        return {'queue': self.queue}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._recording = threading.local()
+
+    def write(self, path: str, content: Union[str, bytes]) -> None:
+        slice_key = getattr(self._recording, 'slice_key', None)
+        self.queue.put(('write', slice_key, path, content))
+
+    def after_flush(self, path: str, callback: Callable[[], None]) -> None:
+        ''' Call back once content appended to a path was flushed, and when closing '''
+
+        self._callbacks[path] = callback
+
+    @contextmanager
+    def record(self, dataset_class: str, index: int, paths: List[str]):
+        ''' Journal the slice along with the rows sent by the wrapped block, dropped if it fails '''
+
+        slice_key = (dataset_class, index)
+        self._recording.slice_key = slice_key
+        try:
+            yield
+        except BaseException:
+            self.queue.put(('discard', slice_key))
+            raise
+        finally:
+            self._recording.slice_key = None
+        self.queue.put(('record', slice_key, paths))
+
+    def close(self) -> None:
+        ''' Write everything sent so far and release the outputs, failing if the writer stopped '''
+
+        self.queue.put(None)
+        self._thread.join()
+        self._manager.shutdown()
+
+        # outputs truncated by a resumed run may have received nothing since
+        for callback in self._callbacks.values():
+            callback()
+
+        if self._error is not None:
+            raise RuntimeError('output sink stopped, rows sent afterwards are lost') from self._error
+
+    def _run(self) -> None:
+        files, held, closing = {}, {}, False
+        try:
+            while not closing:
+                messages = [self.queue.get()]
+
+                # whatever else arrived meanwhile is handled in the same go
+                while True:
+                    try:
+                        messages.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                unrecorded = []
+                for message in messages:
+                    if message is None:
+                        closing = True
+                    elif message[0] == 'write':
+                        _, slice_key, path, content = message
+                        if slice_key is None:
+                            unrecorded.append((path, content))
+                        else:
+                            held.setdefault(slice_key, []).append((path, content))
+                    elif message[0] == 'discard':
+                        held.pop(message[1], None)
+                    else:
+                        _, slice_key, paths = message
+                        self._write(files, held.pop(slice_key, []))
+                        if self.journal is not None:
+                            self.journal.add(*slice_key, paths, self.outputs)
+
+                self._write(files, unrecorded)
+        except Exception as exception:  # pylint: disable=broad-except
+            logging.exception('output sink stopped, rows sent afterwards are lost')
+            self._error = exception
+        finally:
+            for writer in files.values():
+                writer.close()
+
+    def _write(self, files: Dict[str, IO], contents: List[Tuple[str, Union[str, bytes]]]) -> None:
+        ''' Append contents to their outputs and flush them '''
+
+        written = set()
+        for path, content in contents:
+            if path not in files:
+                mode = 'ab' if isinstance(content, bytes) else 'a'
+                files[path] = open(path, mode, buffering=self.buffer_size)
+            files[path].write(content)
+            written.add(path)
+
+        for path in written:
+            files[path].flush()
+            if path in self._callbacks:
+                self._callbacks[path]()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules of ml_project import each other as top-level names, as when run as scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ml_project'))
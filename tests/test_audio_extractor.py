@@ -0,0 +1,57 @@
+from patterns.audio_extractor import Spectra, SpectraStream
+import librosa
+import numpy
+import pytest
+
+
+SR = 22050
+
+
+@pytest.fixture(scope='module')
+def signal() -> numpy.ndarray:
+    '''Three seconds of chords over noise, with silent edges.'''
+
+    rng = numpy.random.default_rng(0)
+    t = numpy.arange(3 * SR) / SR
+    tones = sum(numpy.sin(2 * numpy.pi * f * t) for f in (261.63, 329.63, 392.0, 880.0))
+    data = 0.2 * tones + 0.05 * rng.standard_normal(len(t))
+    data[:SR // 4] = data[-SR // 4:] = 0.0
+    return data.astype(numpy.float32)
+
+
+def test_spectra_matches_librosa(signal):
+    spectra = Spectra(signal, SR)
+
+    numpy.testing.assert_allclose(
+        spectra.chroma('cqt'), librosa.feature.chroma_cqt(y=signal, sr=SR))
+    numpy.testing.assert_allclose(
+        spectra.spectral_contrast(), librosa.feature.spectral_contrast(y=signal, sr=SR))
+    numpy.testing.assert_allclose(
+        spectra.mfcc(), librosa.feature.mfcc(y=signal, sr=SR), rtol=1e-5, atol=1e-3)
+
+
+def test_stft_chroma_close_to_cqt(signal):
+    spectra = Spectra(signal, SR)
+    cqt, stft = spectra.chroma('cqt'), spectra.chroma('stft')
+
+    # the extracted feature is the mean, the notes of the chord lead both
+    assert abs(numpy.mean(cqt) - numpy.mean(stft)) < 0.1
+    notes = {0, 4, 7, 9}
+    assert set(numpy.argsort(cqt.mean(axis=1))[-4:]) == notes
+    assert set(numpy.argsort(stft.mean(axis=1))[-4:]) == notes
+
+
+@pytest.mark.parametrize('block_size', [700, 4096, 65536, 1 << 18])
+def test_stream_matches_spectra(signal, block_size):
+    spectra = Spectra(signal, SR)
+    tuning = librosa.estimate_tuning(S=spectra.power, sr=SR, bins_per_octave=12)
+
+    def blocks():
+        for start in range(0, len(signal), block_size):
+            yield signal[start:start + block_size]
+
+    chroma, contrast, mfcc = SpectraStream(blocks, SR, tuning=tuning).means()
+
+    assert chroma == pytest.approx(numpy.mean(spectra.chroma('stft')), rel=1e-5)
+    assert contrast == pytest.approx(numpy.mean(spectra.spectral_contrast()), rel=1e-5)
+    numpy.testing.assert_allclose(mfcc, spectra.mfcc().mean(axis=1), rtol=1e-5, atol=1e-4)